@@ -2,7 +2,7 @@
 
 {
     "name": "Package Hierarchy",
-    "version": "11.0",
+    "version": "11.4",
     "summary": "Inventory, Logistics, Warehousing",
     "description": "Add the ability for multi-level packages back to Odoo",
     "depends": ["stock", "udes_common"],
@@ -0,0 +1,17 @@
+"""Backfill the materialised path of existing packages"""
+
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """Compute parent_path for any package that does not have one yet.
+
+    The column is normally filled when the ORM creates it, this covers
+    databases where it was added by hand or left partially populated.
+    """
+    if not version:
+        return
+    cr.execute("SELECT 1 FROM stock_quant_package WHERE parent_path IS NULL LIMIT 1")
+    if cr.fetchone():
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        env["stock.quant.package"]._parent_store_compute()
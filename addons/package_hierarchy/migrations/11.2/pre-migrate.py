@@ -0,0 +1,36 @@
+"""Remove duplicate package links before their signature is made unique"""
+
+
+def migrate(cr, version):
+    """Delete all but the oldest of each set of links with the same parent,
+    child and move lines, which is the link that create would have returned.
+    """
+    if not version:
+        return
+    cr.execute(
+        """
+        WITH link_keys AS (
+            SELECT
+                link.id,
+                link.parent_id,
+                link.child_id,
+                ARRAY(
+                    SELECT rel.move_line_id
+                    FROM package_hierarchy_link_stock_move_line_rel rel
+                    WHERE rel.link_id = link.id
+                    ORDER BY rel.move_line_id
+                ) AS move_line_ids
+            FROM package_hierarchy_link link
+        ),
+        duplicates AS (
+            SELECT
+                id,
+                row_number() OVER (
+                    PARTITION BY parent_id, child_id, move_line_ids ORDER BY id
+                ) AS position
+            FROM link_keys
+        )
+        DELETE FROM package_hierarchy_link
+        WHERE id IN (SELECT id FROM duplicates WHERE position > 1)
+        """
+    )
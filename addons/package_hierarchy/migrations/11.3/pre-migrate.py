@@ -0,0 +1,26 @@
+"""Store the transfer of existing package links"""
+
+
+def migrate(cr, version):
+    """Create and fill the column of the transfer of each link, so that the ORM
+    does not compute it link by link when the module is updated.
+
+    Links with move lines in several transfers take the transfer with the
+    lowest id, as computed by the ORM.
+    """
+    if not version:
+        return
+    cr.execute("ALTER TABLE package_hierarchy_link ADD COLUMN IF NOT EXISTS picking_id integer")
+    cr.execute(
+        """
+        UPDATE package_hierarchy_link link
+        SET picking_id = link_picking.picking_id
+        FROM (
+            SELECT rel.link_id, MIN(ml.picking_id) AS picking_id
+            FROM package_hierarchy_link_stock_move_line_rel rel
+            JOIN stock_move_line ml ON ml.id = rel.move_line_id
+            GROUP BY rel.link_id
+        ) link_picking
+        WHERE link.id = link_picking.link_id
+        """
+    )
@@ -0,0 +1,18 @@
+"""Store the top package of existing quants"""
+
+
+def migrate(cr, version):
+    """Create and fill the column of the outermost package of each quant, so
+    that the ORM creates it without any further computation.
+    """
+    if not version:
+        return
+    cr.execute("ALTER TABLE stock_quant ADD COLUMN IF NOT EXISTS x_top_package_id integer")
+    cr.execute(
+        """
+        UPDATE stock_quant quant
+        SET x_top_package_id = COALESCE(package.x_top_parent_id, package.id)
+        FROM stock_quant_package package
+        WHERE package.id = quant.package_id
+        """
+    )
@@ -1,4 +1,5 @@
 from . import models
+from . import deferred_checks
 from . import stock_move_line
 from . import stock_picking
 from . import stock_quant
@@ -0,0 +1,52 @@
+"""Deferral of package hierarchy checks to the end of the transaction
+
+Bulk operations such as validating a large picking move many packages,
+and each move would normally revalidate the same package trees. When the
+``defer_package_hierarchy_checks`` context key is set, checks are instead
+collected per method and run once, for every record they were requested
+for, right before the transaction is committed or when
+:func:`run_deferred_checks` is called explicitly.
+"""
+
+from collections import defaultdict
+
+DEFER_CONTEXT_KEY = "defer_package_hierarchy_checks"
+PRECOMMIT_DATA_KEY = "package_hierarchy.deferred_checks"
+
+
+def defer_check(records, method_name):
+    """Queue ``records.<method_name>()`` to be run before commit, if deferral
+    has been requested in the context of ``records``.
+
+    Return whether the check has been deferred, in which case the caller
+    should not run it now.
+    """
+    if not records.env.context.get(DEFER_CONTEXT_KEY):
+        return False
+    precommit = records.env.cr.precommit
+    pending = precommit.data.get(PRECOMMIT_DATA_KEY)
+    if pending is None:
+        env = records.env
+        pending = precommit.data[PRECOMMIT_DATA_KEY] = defaultdict(set)
+        precommit.add(lambda: run_deferred_checks(env))
+    pending[(records._name, method_name)].update(
+        record_id for record_id in records.ids if isinstance(record_id, int)
+    )
+    return True
+
+
+def run_deferred_checks(env):
+    """Run every queued check once for all of the records it was queued for"""
+    pending = env.cr.precommit.data.pop(PRECOMMIT_DATA_KEY, None)
+    if not pending:
+        return
+    context = {
+        key: value
+        for key, value in env.context.items()
+        if key not in (DEFER_CONTEXT_KEY, "bypass_quant_multi_loc_checks")
+    }
+    env = env(context=context)
+    for (model_name, method_name), record_ids in pending.items():
+        records = env[model_name].browse(sorted(record_ids)).exists()
+        if records:
+            getattr(records, method_name)()
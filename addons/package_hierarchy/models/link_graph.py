@@ -0,0 +1,153 @@
+"""Compact id-based graph of package hierarchy links
+
+Validating links works on plain ids rather than recordsets, so building
+chains and detecting loops is linear in the number of links instead of
+relying on recordset filtering and subtraction.
+"""
+
+
+class LinkGraphError(ValueError):
+    """Base class of the problems found in a link graph"""
+
+
+class PackageLoopError(LinkGraphError):
+    """The links would make a package its own ancestor"""
+
+
+class PackageDepthError(LinkGraphError):
+    """The links would chain more packages than permitted"""
+
+
+class MultipleParentsError(LinkGraphError):
+    """The links would move a package into several packages"""
+
+
+class LinkGraph:
+    """Graph of links between packages, each link given as a
+    ``(link id, parent id, child id)`` triple. Links without a parent
+    remove their child package from its current parent (unlinks).
+    """
+
+    __slots__ = ("links", "unlinked_child_ids", "parent_of", "link_of")
+
+    def __init__(self, links):
+        self.links = list(links)
+        # Packages removed from their current parent
+        self.unlinked_child_ids = set()
+        # Proposed parent and link of each child package, in the order of the links
+        self.parent_of = {}
+        self.link_of = {}
+        for link_id, parent_id, child_id in self.links:
+            if parent_id:
+                self.parent_of[child_id] = parent_id
+                self.link_of[child_id] = link_id
+            else:
+                self.unlinked_child_ids.add(child_id)
+
+    def check_children(self):
+        """Check that no package is moved to several packages.
+
+        The only permitted repetition of a child is one unlink with one link,
+        which moves the package from one package into another.
+        """
+        link_counts = {}
+        unlink_counts = {}
+        for link_id, parent_id, child_id in self.links:
+            counts = link_counts if parent_id else unlink_counts
+            counts[child_id] = counts.get(child_id, 0) + 1
+        for child_id in set(link_counts).union(unlink_counts):
+            num_links = link_counts.get(child_id, 0)
+            num_unlinks = unlink_counts.get(child_id, 0)
+            if num_links + num_unlinks == 2 and num_unlinks != 1:
+                raise MultipleParentsError(child_id)
+            if num_links + num_unlinks > 2:
+                raise MultipleParentsError(child_id)
+
+    def chains(self, max_depth):
+        """Return the chains of package ids formed by the links, each ordered
+        from the innermost package to the outermost one.
+
+        Each terminal child is followed up through the links until a terminal
+        parent is reached. Unlinks do not take part in chains. Raise
+        PackageLoopError if the links contain a loop, and PackageDepthError
+        if a chain would be longer than max_depth.
+        """
+        parent_of = self.parent_of
+        parent_ids = set(parent_of.values())
+        terminal_child_ids = [child_id for child_id in parent_of if child_id not in parent_ids]
+
+        # Links that have not been traversed yet, including any link that is not the
+        # last one of its child, which can never be traversed
+        links_to_check = {link_id for link_id, parent_id, _child_id in self.links if parent_id}
+
+        chains = []
+        for child_id in terminal_child_ids:
+            chain_length = 2
+            node_id = child_id
+            nodes = [child_id]
+            seen = {child_id}
+            while chain_length <= max_depth:
+                links_to_check.discard(self.link_of[node_id])
+                parent_id = parent_of[node_id]
+                if parent_id in seen:
+                    raise PackageLoopError(parent_id)
+                nodes.append(parent_id)
+                seen.add(parent_id)
+                if parent_id not in parent_of:
+                    # Reached a terminal parent
+                    chains.append(nodes)
+                    break
+                node_id = parent_id
+                chain_length += 1
+            if chain_length > max_depth:
+                raise PackageDepthError(child_id)
+
+        # Every link must have been traversed, any that were missed are in a loop
+        if links_to_check:
+            raise PackageLoopError()
+        return chains
+
+    def package_ids(self):
+        """Return the ids of all packages referenced by the links"""
+        res = set(self.unlinked_child_ids)
+        res.update(self.parent_of)
+        res.update(self.parent_of.values())
+        return res
+
+    def check_forest(self, tree, max_depth):
+        """Check the hierarchy that results from applying the links to the
+        current hierarchy.
+
+        The links and unlinks are overlaid on the parents of the packages of
+        tree, a PackageTree holding the ancestors of the linked packages and
+        the contents of the packages moved by the links, which are the only
+        packages whose level can change.
+        Each package is then visited once, walking up to the first package
+        of known level, so every affected tree is checked in a single pass.
+        Raise PackageLoopError if a package would become its own ancestor,
+        and PackageDepthError if a tree would have more than max_depth levels.
+        """
+        parent_of = {node.id: node.parent_id for node in tree}
+        for child_id in self.unlinked_child_ids:
+            parent_of[child_id] = None
+        parent_of.update(self.parent_of)
+
+        # Number of levels from the outermost package down to each package
+        levels = {}
+        for package_id in parent_of:
+            path = []
+            on_path = set()
+            node_id = package_id
+            while node_id and node_id not in levels:
+                if node_id in on_path:
+                    raise PackageLoopError(node_id)
+                path.append(node_id)
+                on_path.add(node_id)
+                node_id = parent_of.get(node_id)
+            level = levels[node_id] if node_id else 0
+            for node_id in reversed(path):
+                level += 1
+                if level > max_depth:
+                    raise PackageDepthError(node_id)
+                levels[node_id] = level
+        return levels
@@ -1,8 +1,41 @@
-from collections import defaultdict
+import hashlib
+
+from psycopg2 import IntegrityError, errorcodes
+from psycopg2.extensions import TransactionRollbackError
 
 from odoo import api, models, fields, _
 from odoo.exceptions import ValidationError
 
+from .deferred_checks import defer_check
+from .link_graph import (
+    LinkGraph,
+    LinkGraphError,
+    MultipleParentsError,
+    PackageDepthError,
+)
+
+
+def link_signature(parent_id, child_id, move_line_ids):
+    """Return the signature identifying a link between the given packages for
+    the given move lines, regardless of the order of the move lines"""
+    key = "%s/%s/%s" % (
+        parent_id or "",
+        child_id or "",
+        ",".join(str(move_line_id) for move_line_id in sorted(move_line_ids)),
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class DuplicateLinkConflict(TransactionRollbackError):
+    """Raised when another transaction commits a link with the same signature
+    while links are being created.
+
+    It is reported as a serialization failure, so that Odoo retries the whole
+    transaction, which then finds the committed link.
+    """
+
+    pgcode = errorcodes.SERIALIZATION_FAILURE
+
 
 class PackageHierarchyLink(models.Model):
     """Package Hierarchy Link
@@ -41,6 +74,7 @@ class PackageHierarchyLink(models.Model):
         ondelete="cascade",
         check_company=True,
         required=True,
+        index=True,
     )
     move_line_ids = fields.Many2many(
         "stock.move.line",
@@ -51,85 +85,191 @@ class PackageHierarchyLink(models.Model):
         check_company=True,
     )
     has_move_line = fields.Boolean(compute="_compute_has_move_line", store=True)
+    picking_id = fields.Many2one(
+        "stock.picking",
+        string="Transfer",
+        compute="_compute_picking_id",
+        store=True,
+        index=True,
+        help="Transfer of the move lines of the link, used to find the links "
+        "of a transfer that are validated together.",
+    )
     company_id = fields.Many2one("res.company", default=lambda self: self.env.company)
+    signature = fields.Char(
+        compute="_compute_signature",
+        store=True,
+        copy=False,
+        help="Hash of the parent, child and move lines of the link, used to enforce uniqueness.",
+    )
+
+    _sql_constraints = [
+        (
+            "signature_uniq",
+            "unique(signature)",
+            "You can not have more than one package link with the same parent/child relationship",
+        ),
+    ]
 
     @api.depends("move_line_ids")
     def _compute_has_move_line(self):
         for record in self:
             record.has_move_line = bool(record.move_line_ids)
 
-    @api.model
-    def create(self, vals):
+    @api.depends("move_line_ids.picking_id")
+    def _compute_picking_id(self):
+        for link in self:
+            link.picking_id = link.move_line_ids.picking_id.sorted("id")[:1]
+
+    @api.depends("parent_id", "child_id", "move_line_ids")
+    def _compute_signature(self):
+        for link in self:
+            link.signature = link_signature(
+                link.parent_id.id, link.child_id.id, link.move_line_ids.ids
+            )
+
+    @api.model_create_multi
+    def create(self, vals_list):
         """
         Extend create to prevent creating duplicate parent/child relations
-        and instead return the duplicate. This is in place of a constraint
-        as it is more user friendly
+        and instead return the duplicate, which is more user friendly than
+        the unique constraint on the signature
         (instead of raising an error will simply return the existing link)
+
+        Duplicates are identified by the signature of the link. Those of the
+        whole batch are looked up with a single indexed query, and the links
+        that do not exist yet are created together. Should another transaction
+        create one of them in the meantime, the duplicate cannot be seen from
+        this transaction, so a DuplicateLinkConflict is raised for the whole
+        transaction to be retried. The returned recordset is in the same order
+        as vals_list.
+
+        When links are created, all the links of the batch, including existing
+        ones, are validated together.
         """
-        PackageHierarchyLink = self.env["package.hierarchy.link"]
-
-        move_line_ids = vals.get("move_line_ids")
-        if move_line_ids:
-            move_line_ids = move_line_ids[0][2]
-        existing_link = PackageHierarchyLink.search_read(
-            [
-                ("parent_id", "=", vals.get("parent_id")),
-                ("child_id", "=", vals.get("child_id")),
-                ("move_line_ids", "=", move_line_ids if move_line_ids else False),
-            ],
-            ["id"],
+        # Apply the defaults first, as they may provide the parent or the move lines
+        signatures = [
+            self._get_link_signature(self._add_missing_default_values(vals)) for vals in vals_list
+        ]
+        link_ids = self._get_existing_link_ids({sig for sig in signatures if sig})
+
+        vals_by_signature = {}
+        for index, (signature, vals) in enumerate(zip(signatures, vals_list)):
+            if signature is None:
+                # Not comparable with other links, always create it
+                signature = signatures[index] = ("new", index)
+            if signature not in link_ids:
+                vals_by_signature.setdefault(signature, vals)
+        if not vals_by_signature:
+            return self.browse([link_ids[signature] for signature in signatures])
+        # The links are validated below along with the existing links of the batch
+        unchecked_self = self.with_context(bypass_package_link_constraints=True)
+        try:
+            # Flushing the cursor would run the checks deferred until commit
+            with self.env.cr.savepoint(flush=False):
+                new_links = super(PackageHierarchyLink, unchecked_self).create(
+                    list(vals_by_signature.values())
+                )
+                self.flush(["signature"])
+        except IntegrityError as e:
+            if not self._is_duplicate_link_error(e):
+                raise
+            raise DuplicateLinkConflict(
+                "Package link created by a concurrent transaction: %s" % e
+            ) from e
+        link_ids.update(zip(vals_by_signature.keys(), new_links.ids))
+        links = self.browse([link_ids[signature] for signature in signatures])
+        links.constrain_links()
+        return links
+
+    @api.model
+    def _get_link_signature(self, vals):
+        """Return the signature of the link that would be created from vals,
+        or None if the move lines cannot be determined from the values alone"""
+        move_line_ids = set()
+        for command in vals.get("move_line_ids") or []:
+            if not isinstance(command, (list, tuple)):
+                move_line_ids.add(command)
+            elif command[0] == 6:
+                move_line_ids = set(command[2] or [])
+            elif command[0] == 4:
+                move_line_ids.add(command[1])
+            else:
+                return None
+        return link_signature(vals.get("parent_id"), vals.get("child_id"), move_line_ids)
+
+    @api.model
+    def _get_existing_link_ids(self, signatures):
+        """Return a dict mapping those of the signatures that already exist
+        to the id of the existing link"""
+        signatures = [sig for sig in signatures if isinstance(sig, str)]
+        if not signatures:
+            return {}
+        self.flush(["signature"])
+        self.env.cr.execute(
+            "SELECT signature, id FROM {table} WHERE signature IN %s".format(table=self._table),
+            [tuple(signatures)],
+        )
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _is_duplicate_link_error(self, error):
+        """Return whether a database error was raised by the link signature
+        uniqueness constraint"""
+        return (
+            error.pgcode == errorcodes.UNIQUE_VIOLATION
+            and error.diag.constraint_name == "%s_signature_uniq" % self._table
         )
-        if existing_link:
-            return PackageHierarchyLink.browse(existing_link[0].get("id"))
-        else:
-            return super().create(vals)
 
     def write(self, vals):
         """
-        Extend write to check for duplicate parent/child relations
-        to raise if the link would become a duplicate
-        """
-        PackageHierarchyLink = self.env["package.hierarchy.link"]
+        Extend write to raise if the link would become a duplicate of
+        another parent/child relation.
 
-        # It's easier to just perform the write and roll-back if it is a duplicate
-        res = super().write(vals)
-        for record in self:
-            move_line_ids = record.move_line_ids.ids
-            links = PackageHierarchyLink.search_read(
-                [
-                    ("parent_id", "=", record.parent_id.id),
-                    ("child_id", "=", record.child_id.id),
-                    ("move_line_ids", "=", move_line_ids if move_line_ids else False),
-                ],
-                ["id"],
-            )
-            if len(links) > 1:
-                raise ValidationError(
-                    _(
-                        "You can not have more than one package link with the same parent/child relationship"
-                    )
+        Duplicates are rejected by the unique index on the signature, so the
+        links are flushed within a savepoint to report them as a validation error.
+        Only the links are flushed, as flushing the cursor would also run the
+        checks deferred until commit.
+        """
+        try:
+            with self.env.cr.savepoint(flush=False):
+                res = super().write(vals)
+                self.flush(["signature"])
+        except IntegrityError as e:
+            if not self._is_duplicate_link_error(e):
+                raise
+            raise ValidationError(
+                _(
+                    "You can not have more than one package link with the same parent/child relationship"
                 )
+            )
         return res
 
     def construct(self):
-        for parent_package, links in self.groupby("parent_id"):
-            links.child_id.write({"parent_id": parent_package.id if parent_package else False})
+        """Move the child packages of the links into their parents, all at once.
+        When a package is both unlinked and linked, the link decides its parent.
+        """
+        Package = self.env["stock.quant.package"]
+
+        graph = self._get_link_graph()
+        parent_ids = dict.fromkeys(graph.unlinked_child_ids, False)
+        parent_ids.update(graph.parent_of)
+        return Package._set_parents(parent_ids)
 
     @api.model
     def create_unlinks(self, packages, move_lines=False):
         """Create links that remove packages from hierarchies."""
-        # Warm the postgres cache
-        packages.get_move_lines_of_children(aux_domain=[("id", "in", move_lines.ids)])
+        # Find the move lines acting on each package tree with a single query
+        move_line_ids_by_package = packages._get_move_line_ids_map(move_lines)
         link_vals = []
         # Create unlinks from higher level packages
         for package in packages:
             if package.parent_id:
-                mls = package.get_move_lines_of_children(aux_domain=[("id", "in", move_lines.ids)])
+                mls = move_line_ids_by_package.get(package.id)
                 link_vals.append(
                     {
                         "parent_id": False,
                         "child_id": package.id,
-                        "move_line_ids": [(6, 0, mls.ids if mls else False)],
+                        "move_line_ids": [(6, 0, mls if mls else False)],
                     }
                 )
 
@@ -149,16 +289,21 @@ class PackageHierarchyLink(models.Model):
     @api.constrains("parent_id", "child_id")
     def constrain_links(self):
         """
-        Find all the links related to the links in self through their moves/moves lines,
-        and call validate links to check that they don't violate any of the constraints.
-
-        NOTE: To be 'more correct' we should check against all links from related move
-        lines that are acting on same package tree, however, this may be computationally
-        expensive for large systems.
+        Find all the links related to the links in self through their transfers, or through
+        their moves/moves lines for those outside of transfers, and call validate links to
+        check that they don't violate any of the constraints.
         """
+        if self._context.get("bypass_package_link_constraints") or defer_check(
+            self, "constrain_links"
+        ):
+            return
         links = self
-        # Get the move lines
-        move_lines = self.move_line_ids
+        # Add the links of the same transfers with a single indexed query
+        links_with_picking = self.filtered("picking_id")
+        if links_with_picking:
+            links |= self.search([("picking_id", "in", links_with_picking.picking_id.ids)])
+        # Get the move lines of the links outside of transfers
+        move_lines = (self - links_with_picking).move_line_ids
         # Add the move lines of associated moves
         move_lines |= move_lines.move_id.move_line_ids
         # Add the links of these move lines
@@ -168,109 +313,62 @@ class PackageHierarchyLink(models.Model):
     def _validate_links(self):
         """Validate package links to ensure that no constraints are broken.
         Current constraints are package depth and package loops.
+
+        All the links in self, including unlinks, are checked together against
+        the whole of every package tree they affect.
         """
-        max_package_depth = self.env.user.get_user_warehouse().x_max_package_depth
+        Package = self.env["stock.quant.package"]
+
+        max_package_depth = self.env.user.get_user_max_package_depth()
+        graph = self._get_link_graph()
 
         # Sanitize links, check for repeated children as we should not have any
         # Only exception may be moving a package from one package into another package. This will
         # create a 'un-link' (no-parent) and a 'link' (with parent).
-        children_count = defaultdict(int)
-        for link in self:
-            children_count[link.child_id] += 1
-        for child_id, count in children_count.items():
-            if count == 2:
-                repeated_links = self.filtered(lambda x: x.child_id == child_id)
-                parent_ids = [link.parent_id.id for link in repeated_links]
-                if parent_ids.count(False) != 1:
-                    raise ValidationError(
-                        _("Links are proposing to move package to several different packages.")
-                    )
-            elif count > 2:
-                raise ValidationError(
-                    _("Links are proposing to move package to several different packages.")
-                )
-
-        # Create chains from the links
-        chains = self._return_chains()
-        # Create a dict of links for efficient searching for unlinks later
-        unlinks_from_child = {link.child_id: link for link in self if not link.parent_id}
-
-        # Now need to check these chains against the current reality
-        # NOTE: Currently this is done for a single chain at a time, if we wanted to be
-        # thorough we should check for multiple chains within the same tree at once. This
-        # would only occur for very complex moves so the computational effort may not be
-        # worth it for a 'normal' system.
-        for chain in chains:
-            # Check for self-ancestors
-            current_ancestors = chain[-1]._return_ancestors()
-            if any(True for node in chain if node in current_ancestors):
-                raise ValidationError(_("Proposed link(s) would result in a package loop"))
-
-            # Check the depth of the proposed tree
-            # Check if there is a relevant unlink
-            if unlinks_from_child.get(chain[-1], False):
-                length_above_chain = 0
-            else:
-                length_above_chain = chain[-1]._return_num_ancestors()
-            # Check depth of each node in the current to see if there is a depth violation
-            allowed_length_below = max_package_depth - length_above_chain
-            for i, node in enumerate(chain):
-                if len(chain) - i + node.x_depth - 1 > allowed_length_below:
-                    raise ValidationError(
-                        _(
-                            "Proposed link(s) would cause package depth "
-                            "to exceed maximum permitted"
-                        )
-                    )
+        try:
+            graph.check_children()
+            # Check the links on their own
+            graph.chains(max_package_depth)
+            # Overlay all the links on the ancestors of the linked packages and the
+            # contents of the moved packages, and check every resulting tree at once
+            tree = Package.browse(graph.package_ids())._load_package_tree(
+                subtree_packages=Package.browse(graph.parent_of)
+            )
+            graph.check_forest(tree, max_package_depth)
+        except LinkGraphError as e:
+            raise ValidationError(self._get_link_graph_error_message(e))
 
     def _return_chains(self):
         """Create chains out of links in self.
         These are returned as a list of lists of records to ensure that they are ordered.
         """
-        # 1 Get all terminal children and parents
-        # (excluding unlinks as they do not impact the chains)
-        max_package_depth = self.env.user.get_user_warehouse().x_max_package_depth
-
-        links_excluding_unlinks = self.filtered(lambda l: l.parent_id)
-        parents = links_excluding_unlinks.parent_id
-        children = links_excluding_unlinks.child_id
-        terminal_parents = parents - children
-        terminal_children = children - parents
-
-        # Create a dict of links for efficient searching later
-        link_from_child = {link.child_id: link for link in links_excluding_unlinks}
-
-        # Create a dict to keep track of links that have been checked
-        links_to_check = links_excluding_unlinks
-
-        chains = []
-        # 2 Follow each terminal child up the chain via links until it reaches a terminal parent
-        for child in terminal_children:
-            chain_length = 2
-            current_link = link_from_child[child]
-            nodes = [child]
-            while chain_length <= max_package_depth:
-                links_to_check -= current_link
-                parent = current_link.parent_id
-                if parent in nodes:
-                    raise ValidationError(_("Proposed link(s) would result in a package loop"))
-                nodes.append(parent)
-                if parent in terminal_parents:
-                    # 3 Add the chain when the end has been reached
-                    chains.append(nodes)
-                    break
-                else:
-                    # Get next link in chain
-                    current_link = link_from_child[parent]
-                    chain_length += 1
-            if chain_length > max_package_depth:
-                raise ValidationError(
-                    _("Proposed link(s) would cause package depth to exceed maximum permitted")
-                )
-
-        # 4 Make sure that we traverse every link during steps 2+3, if links are missed
-        # it indicates that a loop is present
-        if links_to_check:
-            raise ValidationError(_("Proposed link(s) would result in a package loop"))
+        Package = self.env["stock.quant.package"]
+
+        max_package_depth = self.env.user.get_user_max_package_depth()
+        try:
+            chains = self._get_link_graph().chains(max_package_depth)
+        except LinkGraphError as e:
+            raise ValidationError(self._get_link_graph_error_message(e))
+        return [[Package.browse(node_id) for node_id in chain] for chain in chains]
+
+    def _get_link_graph(self):
+        """Return the LinkGraph of the links in self, read with a single query"""
+        if not self:
+            return LinkGraph([])
+        self.flush(["parent_id", "child_id"])
+        self.env.cr.execute(
+            "SELECT id, parent_id, child_id FROM {table} WHERE id IN %s".format(table=self._table),
+            [tuple(self.ids)],
+        )
+        rows = {row[0]: row for row in self.env.cr.fetchall()}
+        # Keep the order of self, which decides the order of the chains
+        return LinkGraph(rows[link_id] for link_id in self.ids if link_id in rows)
 
-        return chains
+    @api.model
+    def _get_link_graph_error_message(self, error):
+        """Return the validation error message of a LinkGraphError"""
+        if isinstance(error, MultipleParentsError):
+            return _("Links are proposing to move package to several different packages.")
+        if isinstance(error, PackageDepthError):
+            return _("Proposed link(s) would cause package depth to exceed maximum permitted")
+        return _("Proposed link(s) would result in a package loop")
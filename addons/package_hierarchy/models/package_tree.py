@@ -0,0 +1,44 @@
+"""Compact in-memory snapshots of package hierarchies
+
+Walking ``parent_id``/``child_ids`` through the ORM loads a hierarchy one
+prefetch batch at a time. A :class:`PackageTree` instead holds the
+structure of package trees, loaded with a single query by
+``stock.quant.package._load_package_tree``, as plain ids so the
+validation of package links can run against it without further queries.
+"""
+
+
+class PackageNode:
+    """A package within a :class:`PackageTree`"""
+
+    __slots__ = ("id", "parent_id")
+
+    def __init__(self, package_id, parent_id):
+        self.id = package_id
+        self.parent_id = parent_id
+
+    def __repr__(self):
+        return "PackageNode(%s)" % self.id
+
+
+class PackageTree:
+    """Snapshot of the structure of one or more package trees"""
+
+    __slots__ = ("nodes",)
+
+    def __init__(self):
+        self.nodes = {}
+
+    def __contains__(self, package_id):
+        return package_id in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        """Add a node to the snapshot"""
+        self.nodes[node.id] = node
+        return node
@@ -12,9 +12,13 @@ class ResUser(models.Model):
         user = self.env.user
         if not user:
             raise ValidationError(_("Cannot find user to get warehouse."))
-        warehouse = Warehouse.search([("company_id", "=", user.company_id.id)])
+        warehouse = Warehouse.browse(Warehouse._get_company_warehouse_ids(user.company_id.id))
         if not warehouse:
             raise ValidationError(_("Cannot find a warehouse for user"))
         if len(warehouse) > 1:
             raise ValidationError(_("Found multiple warehouses for user"))
         return warehouse
+
+    def get_user_max_package_depth(self):
+        """Get the maximum package depth permitted by the warehouse of the user"""
+        return self.get_user_warehouse().x_max_package_depth
@@ -1,6 +1,8 @@
 from odoo import api, models, fields, _
 from odoo.exceptions import ValidationError
 
+from .deferred_checks import DEFER_CONTEXT_KEY, defer_check, run_deferred_checks
+
 
 class StockMoveLine(models.Model):
     _inherit = "stock.move.line"
@@ -21,13 +23,22 @@ class StockMoveLine(models.Model):
            individually at the destination location and are attached to the relevant package.
            This may result in a temporary situation where a package contains quants from both
            the source and destination location.
+        - Construct the links of all move lines at once, deferring the hierarchy checks
+          so that each affected package tree is validated only once.
         """
         super(StockMoveLine, self.with_context(bypass_quant_multi_loc_checks=True))._action_done()
 
-        for dest_location, move_lines in self.exists().groupby("location_dest_id"):
-            move_lines.x_result_package_link_ids.construct()
+        deferred_self = self.exists().with_context(**{DEFER_CONTEXT_KEY: True})
+        deferred_self.x_result_package_link_ids.construct()
+        # Leave the checks queued when the caller deferred them itself
+        if not self.env.context.get(DEFER_CONTEXT_KEY):
+            run_deferred_checks(self.env)
 
-        self.result_package_id.quant_ids._constrain_package()
+        # Check each tree that received stock once, rather than every quant of every package
+        if not self.env.context.get("bypass_quant_multi_loc_checks"):
+            top_packages = self.result_package_id._get_top_packages()
+            if not defer_check(top_packages, "_check_not_multi_location"):
+                top_packages._check_not_multi_location()
 
     def construct_package_hierarchy_links(self):
         """Construct links when entire packages are being moved.
@@ -38,7 +49,7 @@ class StockMoveLine(models.Model):
         PackageHierarchyLink = self.env["package.hierarchy.link"]
 
         packages = Package.search([("id", "parent_of", self.package_id.ids)])
-        packages_fulfilled = packages.filtered(lambda p: p.is_fulfilled_by(self))
+        packages_fulfilled = packages.filter_fulfilled_by(self)
         top_fulfilled_packages = packages_fulfilled.filtered(
             lambda p: p.parent_id and p.parent_id not in packages_fulfilled
         )
@@ -1,10 +1,65 @@
 from odoo import fields, models, _
 from odoo.exceptions import UserError
 
+from .stock_quant_package import parent_path_within
+
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
 
+    x_hierarchy_package_ids = fields.Many2many(
+        "stock.quant.package",
+        string="Package Hierarchy",
+        compute="_compute_hierarchy_package_ids",
+        search="_search_hierarchy_package_ids",
+        help="Packages acted on by the move lines of the transfer, "
+        "along with the packages containing them.",
+    )
+
+    def _compute_hierarchy_package_ids(self):
+        Package = self.env["stock.quant.package"]
+
+        for picking in self:
+            move_lines = picking.move_line_ids
+            packages = move_lines.package_id | move_lines.result_package_id
+            picking.x_hierarchy_package_ids = Package.browse(
+                {
+                    int(package_id)
+                    for parent_path in packages.mapped("parent_path")
+                    if parent_path
+                    for package_id in parent_path.split("/")[:-1]
+                }
+            )
+
+    def _search_hierarchy_package_ids(self, operator, value):
+        """Search for the transfers with move lines acting on the given packages
+        or any package within them, as a subquery over the move lines so that
+        they are never loaded"""
+        MoveLine = self.env["stock.move.line"]
+        Package = self.env["stock.quant.package"]
+
+        if operator not in ("=", "in"):
+            raise UserError(_("Operation not supported"))
+        package_ids = value if isinstance(value, (list, tuple)) else [value]
+        package_ids = tuple(package_id for package_id in package_ids if package_id)
+        if not package_ids:
+            return [("id", "=", False)]
+        MoveLine.flush(["picking_id", "package_id", "result_package_id"])
+        Package.flush(["parent_path"])
+        query = """
+            SELECT ml.picking_id
+            FROM {move_line_table} ml
+            JOIN {package_table} package ON package.id IN (ml.package_id, ml.result_package_id)
+            JOIN {package_table} ancestor
+                ON {within}
+            WHERE ancestor.id IN %s AND ml.picking_id IS NOT NULL
+        """.format(
+            move_line_table=MoveLine._table,
+            package_table=Package._table,
+            within=parent_path_within("package", "ancestor"),
+        )
+        return [("id", "inselect", (query, [package_ids]))]
+
     def _check_entire_pack(self):
         """Create links when moving entire parent packages."""
         super(StockPicking, self)._check_entire_pack()
@@ -1,19 +1,72 @@
-from odoo import api, models
+from odoo import api, fields, models
 from odoo.exceptions import ValidationError
 
+from .deferred_checks import defer_check
+
 
 class StockQuant(models.Model):
     _inherit = "stock.quant"
 
+    x_top_package_id = fields.Many2one(
+        "stock.quant.package",
+        string="Top Package",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="The outermost package containing the quant.",
+    )
+
+    @api.model
+    def create(self, vals):
+        """Extend create to set the top package of quants created in a package"""
+        quant = super().create(vals)
+        quant.filtered("package_id")._update_top_packages()
+        return quant
+
+    def write(self, vals):
+        """Extend write to maintain the top package when quants change package"""
+        res = super().write(vals)
+        if "package_id" in vals:
+            self._update_top_packages()
+        return res
+
+    def _update_top_packages(self):
+        """Set x_top_package_id of the quants in self from their package"""
+        Package = self.env["stock.quant.package"]
+
+        if not self:
+            return
+        self.flush(["package_id"])
+        self.env.cr.execute(
+            """
+            UPDATE {quant_table} quant
+            SET x_top_package_id = top.package_id
+            FROM (
+                SELECT q.id, COALESCE(package.x_top_parent_id, package.id) AS package_id
+                FROM {quant_table} q
+                LEFT JOIN {package_table} package ON package.id = q.package_id
+                WHERE q.id IN %s
+            ) top
+            WHERE quant.id = top.id AND quant.x_top_package_id IS DISTINCT FROM top.package_id
+            """.format(
+                quant_table=self._table, package_table=Package._table
+            ),
+            [tuple(self.ids)],
+        )
+        self.invalidate_cache(["x_top_package_id"])
+
     @api.constrains("package_id")
     def _constrain_package(self):
         """Check that changing the package won't violate multi-location constraints.
 
         We cannot just check the top-parent package as the package may not have a parent.
         """
-        if not self._context.get("bypass_quant_multi_loc_checks"):
-            self.package_id._check_not_multi_location()
-            self.package_id._check_top_parent_not_multi_location()
+        if self._context.get("bypass_quant_multi_loc_checks") or defer_check(
+            self, "_constrain_package"
+        ):
+            return
+        packages = self.package_id
+        (packages | packages.x_top_parent_id)._check_not_multi_location()
 
     @api.model
     def _get_quants_action(self, domain=None, extend=False):
@@ -3,13 +3,45 @@
 import logging
 from itertools import chain, tee
 
-from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError, ValidationError
 from odoo.tools.float_utils import float_is_zero, float_compare
 
+from .deferred_checks import defer_check
+from .package_tree import PackageNode, PackageTree
+
 _logger = logging.getLogger(__name__)
 
 
+def quantities_fulfilled(pack_qtys, mls_qtys, precision_digits):
+    """Check that the quantities of a package, grouped by key, are fulfilled by
+    the quantities of move lines grouped by the same keys"""
+    for key in set(chain(pack_qtys.keys(), mls_qtys.keys())):
+        if (
+            float_compare(
+                pack_qtys.get(key, 0), mls_qtys.get(key, 0), precision_digits=precision_digits
+            )
+            > 0
+        ):
+            return False
+    return True
+
+
+def parent_path_within(alias, ancestor_alias):
+    """Return an SQL condition matching the packages aliased as alias whose
+    materialised path is within that of the package aliased as ancestor_alias,
+    including the package itself.
+
+    The paths within ``1/`` are the range ``['1/', '10')``: the trailing '/'
+    of the ancestor path is replaced by '0', the character after it.
+    """
+    return (
+        "{alias}.parent_path ~>=~ {ancestor}.parent_path "
+        "AND {alias}.parent_path ~<~ "
+        "(substr({ancestor}.parent_path, 1, length({ancestor}.parent_path) - 1) || '0')"
+    ).format(alias=alias, ancestor=ancestor_alias)
+
+
 def pairwise(original_list):
     """"
     Returning couples of a list with N elements, example:
@@ -24,6 +56,7 @@ class QuantPackage(models.Model):
 
     _inherit = "stock.quant.package"
     _parent_name = "parent_id"
+    _parent_store = True
     _parent_order = "name"
     _order = "id"
 
@@ -34,8 +67,9 @@ class QuantPackage(models.Model):
         ondelete="restrict",
         help="The package containing this item",
     )
+    parent_path = fields.Char(index=True)
     x_top_parent_id = fields.Many2one(
-        "stock.quant.package", compute="_compute_top_parent_id", store=True
+        "stock.quant.package", readonly=True, copy=False, index=True
     )
     x_aggregated_quant_ids = fields.One2many(
         "stock.quant",
@@ -47,44 +81,298 @@ class QuantPackage(models.Model):
         ),
     )
     child_ids = fields.One2many("stock.quant.package", "parent_id", "Contained Packages")
-    x_depth = fields.Integer(string="Depth", compute="_compute_depth", store=True)
+    x_depth = fields.Integer(string="Depth", default=1, readonly=True, copy=False)
 
-    @api.depends("parent_id", "parent_id.x_top_parent_id")
-    def _compute_top_parent_id(self):
-        for pack in self:
-            parent = pack.parent_id
-            if not parent:
-                pack.x_top_parent_id = False
-            elif parent.x_top_parent_id:
-                pack.x_top_parent_id = parent.x_top_parent_id
-            else:
-                pack.x_top_parent_id = parent
+    def init(self):
+        """Index the materialised path for prefix scans.
+
+        ``child_of`` and ``parent_of`` domains are resolved with
+        ``parent_path LIKE 'x/y/%'``, which can only use a btree index
+        built with ``text_pattern_ops`` outside of the C collation.
+
+        A LIKE pattern is only matched against the index when it is a constant,
+        so queries joining packages to their descendants instead compare with
+        a range of paths using the ``~>=~`` and ``~<~`` operators of
+        ``text_pattern_ops``, see parent_path_within.
+        """
+        tools.create_index(
+            self._cr,
+            "stock_quant_package_parent_path_pattern_index",
+            self._table,
+            ["parent_path text_pattern_ops"],
+        )
+
+    def _parent_store_update(self):
+        """Report recursion as a validation error, in line with
+        _check_package_recursion"""
+        try:
+            return super()._parent_store_update()
+        except UserError:
+            raise ValidationError(_("A package cannot be its own ancestor."))
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Extend create to maintain the hierarchy fields of packages created
+        inside another package"""
+        packages = super().create(vals_list)
+        contained_packages = packages.filtered("parent_id")
+        if contained_packages:
+            contained_packages._update_hierarchy_fields()
+            contained_packages._check_hierarchy_constraints()
+        return packages
+
+    def write(self, vals):
+        """Extend write to maintain the hierarchy fields when packages are moved
+        between parents"""
+        if "parent_id" not in vals:
+            return super().write(vals)
+        old_parents = self.parent_id
+        res = super().write(vals)
+        self._update_hierarchy_fields(old_parents)
+        self._check_hierarchy_constraints()
+        return res
+
+    def unlink(self):
+        """Extend unlink to update the depth of the parents of removed packages"""
+        parents = self.parent_id - self
+        res = super().unlink()
+        parents.exists()._update_depths()
+        return res
+
+    @api.model
+    def _set_parents(self, parent_ids):
+        """Move packages into new parents in bulk, bypassing write.
+
+        parent_ids maps the id of each package to move to the id of its new
+        parent, or to False to remove it from its parent. All parents are set
+        with a single update, once it is known that no package would become its
+        own ancestor, and the materialised paths of everything within the moved
+        packages are rebuilt with a single recursive update. The
+        hierarchy fields are then maintained and the hierarchy constraints
+        checked once for the whole batch.
+
+        Return the packages whose parent changed.
+        """
+        if not parent_ids:
+            return self.browse()
+        self.flush(["parent_id", "parent_path"])
+        # Check for loops before anything is changed
+        self._check_new_parents_not_recursive(parent_ids)
+        package_ids = list(parent_ids)
+        # Mark the fields depending on the former parents, as write does
+        self.browse(package_ids).modified(["parent_id"], before=True)
+        self.env.cr.execute(
+            """
+            UPDATE {table} package
+            SET parent_id = new.parent_id, write_uid = %s, write_date = (now() at time zone 'UTC')
+            FROM unnest(%s::integer[], %s::integer[]) AS new(id, parent_id), {table} old
+            WHERE package.id = new.id
+                AND old.id = package.id
+                AND package.parent_id IS DISTINCT FROM new.parent_id
+            RETURNING package.id, old.parent_id
+            """.format(
+                table=self._table
+            ),
+            [
+                self.env.uid,
+                package_ids,
+                [parent_ids[package_id] or None for package_id in package_ids],
+            ],
+        )
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return self.browse()
+        packages = self.browse([package_id for package_id, _old_parent_id in rows])
+        old_parents = self.browse({old_parent_id for _id, old_parent_id in rows if old_parent_id})
+
+        # Rebuild the paths from the packages whose parent is outside of the moved trees
+        self.env.cr.execute(
+            """
+            WITH RECURSIVE affected AS (
+                SELECT DISTINCT descendant.id, descendant.parent_id
+                FROM {table} moved
+                JOIN {table} descendant
+                    ON {within}
+                WHERE moved.id IN %s
+            ),
+            paths(id, parent_path) AS (
+                SELECT affected.id, COALESCE(parent.parent_path, '') || affected.id || '/'
+                FROM affected
+                LEFT JOIN {table} parent ON parent.id = affected.parent_id
+                WHERE affected.parent_id IS NULL
+                    OR affected.parent_id NOT IN (SELECT id FROM affected)
+            UNION ALL
+                SELECT affected.id, paths.parent_path || affected.id || '/'
+                FROM affected
+                JOIN paths ON affected.parent_id = paths.id
+            )
+            UPDATE {table} package
+            SET parent_path = paths.parent_path
+            FROM paths
+            WHERE package.id = paths.id
+            """.format(
+                table=self._table,
+                within=parent_path_within("descendant", "moved"),
+            ),
+            [tuple(packages.ids)],
+        )
+
+        self.invalidate_cache(["parent_id", "parent_path", "child_ids"])
+        packages.modified(["parent_id"])
+        packages._update_hierarchy_fields(old_parents)
+        packages._check_hierarchy_constraints()
+        return packages
+
+    @api.model
+    def _check_new_parents_not_recursive(self, parent_ids):
+        """Raise if moving packages into the parents given by parent_ids, as for
+        _set_parents, would make any package its own ancestor.
+
+        The current ancestors of the new parents are read from their materialised
+        paths with a single query, and the new parents overlaid on them.
+        """
+        new_parent_ids = {parent_id for parent_id in parent_ids.values() if parent_id}
+        parent_of = {}
+        if new_parent_ids:
+            self.env.cr.execute(
+                "SELECT parent_path FROM {table} WHERE id IN %s".format(table=self._table),
+                [tuple(new_parent_ids)],
+            )
+            for (parent_path,) in self.env.cr.fetchall():
+                path_ids = [int(package_id) for package_id in parent_path.split("/")[:-1]]
+                parent_of.update(zip(path_ids, [None] + path_ids[:-1]))
+        parent_of.update(
+            (package_id, parent_id or None) for package_id, parent_id in parent_ids.items()
+        )
+        for package_id in parent_ids:
+            seen = set()
+            node_id = package_id
+            while node_id:
+                if node_id in seen:
+                    raise ValidationError(_("A package cannot be its own ancestor."))
+                seen.add(node_id)
+                node_id = parent_of.get(node_id)
+
+    def _update_hierarchy_fields(self, old_parents=None):
+        """Update x_top_parent_id and x_depth after the packages in self have been
+        moved from old_parents into their current parents.
+
+        Rather than recomputing level by level through the ORM, the top parent of
+        everything within the moved packages and the depth of their current and
+        former ancestors are set with a handful of set-based queries.
+        """
+        self._update_top_parents()
+        (self | (old_parents or self.browse()))._update_depths()
+
+    def _update_top_parents(self):
+        """Set x_top_parent_id of the packages in self and all of their contents
+        from the first entry of their materialised path"""
+        if not self:
+            return
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            UPDATE {table} package
+            SET x_top_parent_id = NULLIF(split_part(package.parent_path, '/', 1)::integer, package.id)
+            FROM {table} moved
+            WHERE moved.id IN %s
+                AND {within}
+                AND package.x_top_parent_id IS DISTINCT FROM
+                    NULLIF(split_part(package.parent_path, '/', 1)::integer, package.id)
+            """.format(
+                table=self._table,
+                within=parent_path_within("package", "moved"),
+            ),
+            [tuple(self.ids)],
+        )
+        self.invalidate_cache(["x_top_parent_id"])
+        self._update_quant_top_packages()
+
+    def _update_quant_top_packages(self):
+        """Set x_top_package_id of the quants in the packages in self and all of
+        their contents"""
+        Quant = self.env["stock.quant"]
+
+        Quant.flush(["package_id"])
+        self.env.cr.execute(
+            """
+            UPDATE {quant_table} quant
+            SET x_top_package_id = COALESCE(package.x_top_parent_id, package.id)
+            FROM {package_table} package, {package_table} moved
+            WHERE moved.id IN %s
+                AND {within}
+                AND quant.package_id = package.id
+                AND quant.x_top_package_id IS DISTINCT FROM
+                    COALESCE(package.x_top_parent_id, package.id)
+            """.format(
+                quant_table=Quant._table,
+                package_table=self._table,
+                within=parent_path_within("package", "moved"),
+            ),
+            [tuple(self.ids)],
+        )
+        Quant.invalidate_cache(["x_top_package_id"])
+
+    def _update_depths(self):
+        """Set x_depth of the packages in self and all of their ancestors to the
+        number of levels down to their deepest contained package"""
+        if not self:
+            return
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            "SELECT parent_path FROM {table} WHERE id IN %s".format(table=self._table),
+            [tuple(self.ids)],
+        )
+        package_ids = {
+            int(package_id)
+            for (parent_path,) in self.env.cr.fetchall()
+            for package_id in parent_path.split("/")[:-1]
+        }
+        self.env.cr.execute(
+            """
+            UPDATE {table} package
+            SET x_depth = levels.depth
+            FROM (
+                SELECT
+                    ancestor.id,
+                    MAX(char_length(descendant.parent_path)
+                        - char_length(replace(descendant.parent_path, '/', '')))
+                    - (char_length(ancestor.parent_path)
+                        - char_length(replace(ancestor.parent_path, '/', '')))
+                    + 1 AS depth
+                FROM {table} ancestor
+                JOIN {table} descendant
+                    ON {within}
+                WHERE ancestor.id IN %s
+                GROUP BY ancestor.id, ancestor.parent_path
+            ) levels
+            WHERE package.id = levels.id AND package.x_depth IS DISTINCT FROM levels.depth
+            """.format(
+                table=self._table,
+                within=parent_path_within("descendant", "ancestor"),
+            ),
+            [tuple(package_ids)],
+        )
+        self.invalidate_cache(["x_depth"])
+
+    def _check_hierarchy_constraints(self):
+        """Check the constraints affected by moving the packages in self"""
+        self._constrain_depth()
+        self._check_top_parent_not_multi_location()
 
-    @api.constrains("parent_id", "child_ids")
     @api.onchange("parent_id", "child_ids")
     def _constrain_depth(self):
-        max_package_depth = self.env.user.get_user_warehouse().x_max_package_depth
+        if defer_check(self, "_constrain_depth"):
+            return
+        max_package_depth = self.env.user.get_user_max_package_depth()
         for pack in self:
             top_parent = pack.x_top_parent_id
             if top_parent.x_depth > max_package_depth:
                 raise ValidationError(_("Maximum package depth exceeded."))
 
-    @api.depends("child_ids", "child_ids.x_depth")
-    def _compute_depth(self):
-        """Is the max depth of any children"""
-        for pack in self:
-            children = pack.child_ids
-            if not children:
-                pack.x_depth = 1
-            else:
-                pack.x_depth = max(pack.child_ids.mapped("x_depth")) + 1
-
-    @api.constrains("x_top_parent_id")
     def _check_top_parent_not_multi_location(self):
-        # Need trigger x_aggregated_quant_ids of top parent to be recomputed
-        # before checking for multi-location as this may not have happened
-        # automatically.
-        self.x_top_parent_id._compute_aggregated_quant_ids()
+        if defer_check(self, "_check_top_parent_not_multi_location"):
+            return
         self.x_top_parent_id._check_not_multi_location()
 
     @api.constrains("parent_id")
@@ -92,23 +380,188 @@ class QuantPackage(models.Model):
         if not self._check_recursion("parent_id"):
             raise ValidationError("A package cannot be its own ancestor.")
 
+    def _get_top_packages(self):
+        """Return the outermost packages of the trees of the packages in self,
+        which are the packages themselves for those without a parent"""
+        return self.x_top_parent_id | self.filtered(lambda p: not p.x_top_parent_id)
+
     def _check_not_multi_location(self):
-        for package in self:
+        for package in self.browse(self._get_multi_location_package_ids()):
             locations = package.x_aggregated_quant_ids.location_id
-            if len(locations) > 1:
-                raise ValidationError(
-                    _("Package cannot be in multiple " "locations:\n%s\n%s")
-                    % (package.name, ", ".join([l.name for l in locations]))
-                )
+            raise ValidationError(
+                _("Package cannot be in multiple " "locations:\n%s\n%s")
+                % (package.name, ", ".join([l.name for l in locations]))
+            )
+
+    def _get_multi_location_package_ids(self):
+        """Return the ids of the packages in self whose contents, including the
+        contents of contained packages, are spread over more than one location.
+
+        This is checked for the whole recordset with a single aggregate query.
+        """
+        Quant = self.env["stock.quant"]
+
+        if not self:
+            return []
+        Quant.flush(["package_id", "location_id", "quantity", "reserved_quantity"])
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            SELECT package.id
+            FROM {package_table} package
+            JOIN {package_table} descendant
+                ON {within}
+            JOIN {quant_table} quant ON quant.package_id = descendant.id
+            WHERE package.id IN %s AND (quant.quantity != 0 OR quant.reserved_quantity != 0)
+            GROUP BY package.id
+            HAVING COUNT(DISTINCT quant.location_id) > 1
+            ORDER BY package.id
+            """.format(
+                package_table=self._table,
+                quant_table=Quant._table,
+                within=parent_path_within("descendant", "package"),
+            ),
+            [tuple(self.ids)],
+        )
+        return [package_id for (package_id,) in self.env.cr.fetchall()]
 
     def _return_num_ancestors(self):
         self.ensure_one()
-        return self.search_count([("id", "parent_of", self.id)]) - 1
+        return self._get_num_ancestors_map()[self.id]
 
     def _return_ancestors(self):
         self.ensure_one()
-        packages = self.search([("id", "parent_of", self.id)])
-        return packages - self
+        return self.browse(self._get_ancestor_ids_map()[self.id])
+
+    def _get_ancestor_ids_map(self):
+        """Return a dict mapping the id of each package in self to the ids of its
+        ancestors, ordered from the immediate parent up to the top parent.
+
+        The ancestors of the whole recordset are fetched with a single recursive query.
+        """
+        if not self:
+            return {}
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            WITH RECURSIVE ancestors(package_id, ancestor_id, level) AS (
+                SELECT id, parent_id, 1
+                FROM {table}
+                WHERE id IN %s AND parent_id IS NOT NULL
+            UNION ALL
+                SELECT a.package_id, p.parent_id, a.level + 1
+                FROM ancestors a
+                JOIN {table} p ON p.id = a.ancestor_id
+                WHERE p.parent_id IS NOT NULL
+            )
+            SELECT package_id, ancestor_id FROM ancestors ORDER BY package_id, level
+            """.format(
+                table=self._table
+            ),
+            [tuple(self.ids)],
+        )
+        res = {package_id: [] for package_id in self.ids}
+        for package_id, ancestor_id in self.env.cr.fetchall():
+            res[package_id].append(ancestor_id)
+        return res
+
+    def _get_descendant_ids_map(self):
+        """Return a dict mapping the id of each package in self to the ids of all
+        packages contained within it at any level, ordered by level then id.
+
+        The descendants of the whole recordset are fetched with a single recursive query.
+        """
+        if not self:
+            return {}
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            WITH RECURSIVE descendants(package_id, descendant_id, level) AS (
+                SELECT parent_id, id, 1
+                FROM {table}
+                WHERE parent_id IN %s
+            UNION ALL
+                SELECT d.package_id, p.id, d.level + 1
+                FROM descendants d
+                JOIN {table} p ON p.parent_id = d.descendant_id
+            )
+            SELECT package_id, descendant_id FROM descendants
+            ORDER BY package_id, level, descendant_id
+            """.format(
+                table=self._table
+            ),
+            [tuple(self.ids)],
+        )
+        res = {package_id: [] for package_id in self.ids}
+        for package_id, descendant_id in self.env.cr.fetchall():
+            res[package_id].append(descendant_id)
+        return res
+
+    def _get_num_ancestors_map(self):
+        """Return a dict mapping the id of each package in self to its number of ancestors"""
+        return {
+            package_id: len(ancestor_ids)
+            for package_id, ancestor_ids in self._get_ancestor_ids_map().items()
+        }
+
+    def _load_package_tree(self, subtree_packages=None):
+        """Load the packages in self, their ancestors and every package within
+        subtree_packages into a PackageTree snapshot.
+
+        The ancestors are read from the materialised paths of the packages, and
+        the subtrees through the materialised paths of subtree_packages, in a
+        single query, so the rest of the trees containing them is not loaded.
+        """
+        tree = PackageTree()
+        if not self:
+            return tree
+        subtree_packages = subtree_packages or self.browse()
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            SELECT package.id, package.parent_id
+            FROM {table} package
+            WHERE package.id IN (
+                SELECT unnest(string_to_array(rtrim(parent_path, '/'), '/')::integer[])
+                FROM {table}
+                WHERE id IN %s
+            )
+            UNION
+            SELECT package.id, package.parent_id
+            FROM {table} root
+            JOIN {table} package
+                ON {within}
+            WHERE root.id = ANY(%s)
+            """.format(
+                table=self._table,
+                within=parent_path_within("package", "root"),
+            ),
+            [tuple(self.ids), subtree_packages.ids],
+        )
+        for package_id, parent_id in self.env.cr.fetchall():
+            tree.add(PackageNode(package_id, parent_id))
+        return tree
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            SELECT package.id, package.parent_id
+            FROM {table} root
+            JOIN {table} package
+                ON {within}
+            WHERE root.id IN (
+                SELECT DISTINCT split_part(parent_path, '/', 1)::integer
+                FROM {table}
+                WHERE id IN %s
+            )
+            """.format(
+                table=self._table,
+                within=parent_path_within("package", "root"),
+            ),
+            [tuple(self.ids)],
+        )
+        for package_id, parent_id in self.env.cr.fetchall():
+            tree.add(PackageNode(package_id, parent_id))
+        return tree
 
     @api.depends(
         "child_ids",
@@ -119,18 +572,47 @@ class QuantPackage(models.Model):
     def _compute_aggregated_quant_ids(self):
         Quant = self.env["stock.quant"]
 
-        for package in self:
-            if isinstance(package.id, models.NewId):
-                package.x_aggregated_quant_ids = package.quant_ids
-            else:
-                package.x_aggregated_quant_ids = Quant.search(
-                    [
-                        ("package_id", "child_of", package.id),
-                        "|",
-                        ("quantity", "!=", 0),
-                        ("reserved_quantity", "!=", 0),
-                    ]
-                )
+        new_packages = self.filtered(lambda p: isinstance(p.id, models.NewId))
+        for package in new_packages:
+            package.x_aggregated_quant_ids = package.quant_ids
+        packages = self - new_packages
+        aggregated_quant_ids = packages._get_aggregated_quant_ids_map()
+        for package in packages:
+            package.x_aggregated_quant_ids = Quant.browse(aggregated_quant_ids[package.id])
+
+    def _get_aggregated_quant_ids_map(self):
+        """Return a dict mapping the id of each package in self to the ids of the
+        non-empty quants contained within the package and its contained packages.
+
+        The quants of outermost packages are read directly through the top package
+        stored on each quant. Those of contained packages are fetched with a single
+        search and distributed to each package using the materialised path of
+        their package.
+        """
+        Quant = self.env["stock.quant"]
+
+        res = {package_id: [] for package_id in self.ids}
+        if not res:
+            return res
+        non_empty_domain = ["|", ("quantity", "!=", 0), ("reserved_quantity", "!=", 0)]
+        top_packages = self.filtered(lambda p: not p.parent_id)
+        if top_packages:
+            quants = Quant.search(
+                [("x_top_package_id", "in", top_packages.ids)] + non_empty_domain, order="id"
+            )
+            for quant in quants:
+                res[quant.x_top_package_id.id].append(quant.id)
+        contained_package_ids = set((self - top_packages).ids)
+        if contained_package_ids:
+            quants = Quant.search(
+                [("package_id", "child_of", list(contained_package_ids))] + non_empty_domain,
+                order="id",
+            )
+            for quant in quants:
+                for package_id in quant.package_id.parent_path.split("/")[:-1]:
+                    if int(package_id) in contained_package_ids:
+                        res[int(package_id)].append(quant.id)
+        return res
 
     @api.depends(
         "quant_ids.package_id",
@@ -146,34 +628,89 @@ class QuantPackage(models.Model):
         "child_ids.owner_id",
     )
     def _compute_package_info(self):
+        """Compute the location, company and owner shared by the contents of each
+        package, or leave them empty where the contents conflict.
+
+        The quants of all packages are summarised with a single grouped query,
+        and the contained packages of all packages are read together.
+        """
         Location = self.env["stock.location"]
         Company = self.env["res.company"]
         Partner = self.env["res.partner"]
 
+        quant_info = self._get_quant_info_map()
         for package in self:
-            # Initialise empty recordsets
-            comparison_recordsets = {
-                "location_id": Location,
-                "company_id": Company,
-                "owner_id": Partner,
+            # Initialise empty sets of ids
+            comparison_ids = {
+                "location_id": set(),
+                "company_id": set(),
+                "owner_id": set(),
             }
 
-            for records in [package.quant_ids, package.child_ids]:
-                if records:
-                    comparison_recordsets["location_id"] |= records[0].location_id
-                    comparison_recordsets["company_id"] |= records.company_id
-                    comparison_recordsets["owner_id"] |= records.owner_id
+            if package.id in quant_info:
+                location_id, company_ids, owner_ids = quant_info[package.id]
+                comparison_ids["location_id"].add(location_id)
+                comparison_ids["company_id"].update(company_ids)
+                comparison_ids["owner_id"].update(owner_ids)
+            elif isinstance(package.id, models.NewId) and package.quant_ids:
+                quants = package.quant_ids
+                comparison_ids["location_id"].update(quants[0].location_id.ids)
+                comparison_ids["company_id"].update(quants.company_id.ids)
+                comparison_ids["owner_id"].update(quants.owner_id.ids)
+
+            children = package.child_ids
+            if children:
+                comparison_ids["location_id"].update(children[0].location_id.ids)
+                comparison_ids["company_id"].update(children.company_id.ids)
+                comparison_ids["owner_id"].update(children.owner_id.ids)
 
             # If we don't have conflicting records, add to values.
             values = {
-                key: recordsets
-                for (key, recordsets) in comparison_recordsets.items()
-                if len(recordsets) == 1
+                key: next(iter(ids)) for (key, ids) in comparison_ids.items() if len(ids) == 1
             }
 
-            package.location_id = values.get("location_id", False)
-            package.company_id = values.get("company_id", False)
-            package.owner_id = values.get("owner_id", False)
+            package.location_id = Location.browse(values.get("location_id"))
+            package.company_id = Company.browse(values.get("company_id"))
+            package.owner_id = Partner.browse(values.get("owner_id"))
+
+    def _get_quant_info_map(self):
+        """Return a dict mapping the id of each package in self containing quants
+        to a tuple of the location of its first quant, and the sets of the ids of
+        the companies and owners of its quants.
+
+        As for quant_ids, quants with neither a quantity nor a reservation are ignored.
+        """
+        Quant = self.env["stock.quant"]
+
+        package_ids = tuple(package_id for package_id in self.ids if isinstance(package_id, int))
+        if not package_ids:
+            return {}
+        Quant.flush(
+            ["package_id", "location_id", "company_id", "owner_id", "quantity", "reserved_quantity"]
+        )
+        self.env.cr.execute(
+            """
+            SELECT
+                package_id,
+                (array_agg(location_id ORDER BY id))[1],
+                array_agg(DISTINCT company_id),
+                array_agg(DISTINCT owner_id)
+            FROM {table}
+            WHERE package_id IN %s AND (quantity != 0 OR reserved_quantity != 0)
+            GROUP BY package_id
+            """.format(
+                table=Quant._table
+            ),
+            [package_ids],
+        )
+        return {
+            package_id: (
+                location_id,
+                {company_id for company_id in company_ids if company_id},
+                {owner_id for owner_id in owner_ids if owner_id},
+            )
+            for package_id, location_id, company_ids, owner_ids in self.env.cr.fetchall()
+        }
 
     @api.depends("parent_id")
     def _compute_display_name(self):
@@ -188,7 +725,10 @@ class QuantPackage(models.Model):
         """Overide to include picks quants of child packages"""
         Quant = self.env["stock.quant"]
 
-        return Quant.search([("package_id", "child_of", self.ids)])
+        return Quant.search(self._get_contained_quants_domain())
+
+    def _get_contained_quants_domain(self):
+        return [("package_id", "child_of", self.ids)]
 
     def _get_move_lines_of_children_domain(self):
         return [
@@ -207,27 +747,174 @@ class QuantPackage(models.Model):
             kwargs["order"] = "id"
         return MoveLines.search(domain, **kwargs)
 
-    def action_view_picking(self):
-        """Overide to include picks of child packages"""
+    def iter_contained_quants(self, aux_domain=None, page_size=1000):
+        """Iterate over the quants of the packages and their contained packages in
+        pages of at most page_size quants, ordered by id.
+
+        Only one page is held in memory at a time, which suits reports and exports
+        of packages too large to be loaded as a single recordset.
+        """
+        Quant = self.env["stock.quant"]
+
+        domain = self._get_contained_quants_domain()
+        if aux_domain:
+            domain.extend(aux_domain)
+        return self._iter_pages(Quant, domain, page_size)
+
+    def iter_move_lines_of_children(self, aux_domain=None, page_size=1000):
+        """Iterate over the move lines of the packages and their contained packages
+        in pages of at most page_size move lines, ordered by id.
+
+        See iter_contained_quants.
+        """
         MoveLines = self.env["stock.move.line"]
 
-        action = self.env["ir.actions.actions"]._for_xml_id("stock.action_picking_tree_all")
         domain = self._get_move_lines_of_children_domain()
-        pickings = MoveLines.search(domain, order="id").picking_id
-        action["domain"] = [("id", "in", pickings.ids)]
+        if aux_domain:
+            domain.extend(aux_domain)
+        return self._iter_pages(MoveLines, domain, page_size)
+
+    @api.model
+    def _iter_pages(self, model, domain, page_size):
+        """Yield the records of model matching domain in pages of at most page_size
+        records, using the id of the last record of each page to find the next
+        page rather than an offset. Each page is evicted from the cache once the
+        next one is requested."""
+        last_id = 0
+        while True:
+            records = model.search(domain + [("id", ">", last_id)], order="id", limit=page_size)
+            if not records:
+                return
+            yield records
+            last_id = records[-1].id
+            records.flush()
+            records.invalidate_cache(ids=records.ids)
+
+    def _get_move_line_ids_map(self, move_lines):
+        """Return a dict mapping the id of each package in self to the ids of those
+        of the move lines that act on the package or any package within it.
+
+        This is the batch equivalent of calling get_move_lines_of_children restricted
+        to move_lines on each package, resolved with a single query.
+        """
+        res = {package_id: [] for package_id in self.ids}
+        if not res or not move_lines:
+            return res
+        from_clause, params = self._get_move_lines_of_packages_clause(move_lines)
+        self.env.cr.execute(
+            """
+            SELECT package.id, move_line.id
+            {from_clause}
+            ORDER BY package.id, move_line.id
+            """.format(
+                from_clause=from_clause
+            ),
+            params,
+        )
+        for package_id, move_line_id in self.env.cr.fetchall():
+            res[package_id].append(move_line_id)
+        return res
+
+    def _get_move_lines_of_packages_clause(self, move_lines):
+        """Return the FROM clause, with its parameters, pairing each package in
+        self, as ``package``, with those of move_lines acting on the package or
+        any package within it, as ``move_line``.
+
+        The packages are found from the move lines, by splitting the materialised
+        paths of their packages, so the pairs are found in a single pass over the
+        move lines rather than by probing every package against every move line.
+        """
+        MoveLine = self.env["stock.move.line"]
+
+        MoveLine.flush(["package_id", "result_package_id"])
+        self.flush(["parent_id"])
+        from_clause = """
+            FROM (
+                SELECT DISTINCT path.package_id AS id, move_line.id AS move_line_id
+                FROM {move_line_table} move_line
+                JOIN {package_table} descendant
+                    ON descendant.id IN (move_line.package_id, move_line.result_package_id)
+                CROSS JOIN LATERAL unnest(
+                    string_to_array(rtrim(descendant.parent_path, '/'), '/')::integer[]
+                ) AS path(package_id)
+                WHERE move_line.id IN %s AND path.package_id IN %s
+            ) package
+            JOIN {move_line_table} move_line ON move_line.id = package.move_line_id
+        """.format(
+            package_table=self._table,
+            move_line_table=MoveLine._table,
+        )
+        return from_clause, [tuple(move_lines.ids), tuple(self.ids)]
+
+    def action_view_picking(self):
+        """Overide to include picks of child packages.
+
+        The transfers are found by a subquery when the list is displayed, rather than
+        listing them in the domain, so the move lines of the packages are never loaded.
+        """
+        action = self.env["ir.actions.actions"]._for_xml_id("stock.action_picking_tree_all")
+        action["domain"] = [("x_hierarchy_package_ids", "in", self.ids)]
         return action
 
-    def product_quantities_by_key(self, get_key=lambda q: q.product_id):
+    def product_quantities_by_key(self, get_key="product_id"):
         """This function computes the product quantities the given package grouped by a key
         Args:
-            get_key: a callable which takes a quant and returns the key
+            get_key: a callable which takes a quant and returns the key, or the name (or
+                tuple of names) of stored many2one fields of the quant. When field names
+                are given the quantities are summed by the database, and the key is the
+                record (or tuple of records) the quant would have for those fields.
 
         """
+        key_fields = self._get_quant_key_fields(get_key)
+        if key_fields is None:
+            res = {}
+            for key, quant_grp in self._get_contained_quants().groupby(get_key):
+                res[key] = sum(quant_grp.mapped("quantity"))
+            return res
+
+        Quant = self.env["stock.quant"]
+
+        Quant.flush(key_fields + ["package_id", "quantity"])
+        query = Quant._where_calc(self._get_contained_quants_domain())
+        Quant._apply_ir_rules(query, "read")
+        from_clause, where_clause, where_params = query.get_sql()
+        columns = ", ".join('"%s"."%s"' % (Quant._table, name) for name in key_fields)
+        self.env.cr.execute(
+            """
+            SELECT {columns}, SUM("{table}"."quantity")
+            FROM {from_clause}
+            WHERE {where_clause}
+            GROUP BY {columns}
+            """.format(
+                columns=columns,
+                table=Quant._table,
+                from_clause=from_clause,
+                where_clause=where_clause or "TRUE",
+            ),
+            where_params,
+        )
+        comodels = [self.env[Quant._fields[name].comodel_name] for name in key_fields]
         res = {}
-        for key, quant_grp in self._get_contained_quants().groupby(get_key):
-            res[key] = sum(quant_grp.mapped("quantity"))
+        for row in self.env.cr.fetchall():
+            key = tuple(comodel.browse(value) for comodel, value in zip(comodels, row))
+            res[key[0] if isinstance(get_key, str) else key] = row[-1]
         return res
 
+    @api.model
+    def _get_quant_key_fields(self, get_key):
+        """Return the list of quant field names to group by for get_key, or None
+        if get_key cannot be expressed as stored many2one fields of stock.quant"""
+        Quant = self.env["stock.quant"]
+
+        if callable(get_key):
+            return None
+        key_fields = [get_key] if isinstance(get_key, str) else list(get_key)
+        for name in key_fields:
+            field = Quant._fields.get(name)
+            if not (field and field.store and field.type == "many2one"):
+                return None
+        return key_fields
+
     def is_fulfilled_by(self, move_lines):
         """Check if a set of packages are fulfilled by a set of move lines"""
         Precision = self.env["decimal.precision"]
@@ -236,50 +923,103 @@ class QuantPackage(models.Model):
             return (x.product_id, x.lot_id)
 
         precision_digits = Precision.precision_get("Product Unit of Measure")
-        pack_qtys = self.product_quantities_by_key(get_key)
+        pack_qtys = self.product_quantities_by_key(("product_id", "lot_id"))
         pack_move_lines = self.get_move_lines_of_children(aux_domain=[("id", "in", move_lines.ids)])
 
         mls_qtys = {}
         for key, mls_grp in pack_move_lines.groupby(get_key):
             mls_qtys[key] = sum(mls_grp.mapped("product_qty"))
 
-        for key in set(chain(pack_qtys.keys(), mls_qtys.keys())):
-            if (
-                float_compare(
-                    pack_qtys.get(key, 0), mls_qtys.get(key, 0), precision_digits=precision_digits
-                )
-                > 0
-            ):
-                return False
-        return True
+        return quantities_fulfilled(pack_qtys, mls_qtys, precision_digits)
+
+    def filter_fulfilled_by(self, move_lines):
+        """Return the packages in self that are each individually fulfilled by
+        the move lines.
+
+        This is equivalent to filtering self with is_fulfilled_by, but the
+        quantities of every package are aggregated at once over the hierarchy:
+        one query for the contained quants and one for the move lines.
+        """
+        Precision = self.env["decimal.precision"]
+
+        precision_digits = Precision.precision_get("Product Unit of Measure")
+        pack_qtys = self._get_product_lot_quantities_map()
+        mls_qtys = self._get_move_line_product_lot_quantities_map(move_lines)
+        return self.filtered(
+            lambda p: quantities_fulfilled(
+                pack_qtys.get(p.id, {}), mls_qtys.get(p.id, {}), precision_digits
+            )
+        )
+
+    def _get_product_lot_quantities_map(self):
+        """Return a dict mapping the id of each package in self to the quantities
+        of the quants it contains at any level, keyed by (product id, lot id)"""
+        Quant = self.env["stock.quant"]
+
+        if not self:
+            return {}
+        Quant.flush(["package_id", "product_id", "lot_id", "quantity"])
+        self.flush(["parent_id"])
+        self.env.cr.execute(
+            """
+            SELECT package.id, quant.product_id, quant.lot_id, SUM(quant.quantity)
+            FROM {package_table} package
+            JOIN {package_table} descendant
+                ON {within}
+            JOIN {quant_table} quant ON quant.package_id = descendant.id
+            WHERE package.id IN %s
+            GROUP BY package.id, quant.product_id, quant.lot_id
+            """.format(
+                package_table=self._table,
+                quant_table=Quant._table,
+                within=parent_path_within("descendant", "package"),
+            ),
+            [tuple(self.ids)],
+        )
+        return self._group_product_lot_quantities(self.env.cr.fetchall())
+
+    def _get_move_line_product_lot_quantities_map(self, move_lines):
+        """Return a dict mapping the id of each package in self to the quantities
+        of those of the move lines that act on the package or any package within
+        it, keyed by (product id, lot id).
+
+        Each move line is counted once for every package of self in the paths of
+        its packages, so the work grows with the number of move lines and the depth
+        of their packages rather than with the number of packages in self.
+        """
+        MoveLine = self.env["stock.move.line"]
+
+        if not self or not move_lines:
+            return {}
+        MoveLine.flush(["product_id", "lot_id", "product_qty"])
+        from_clause, params = self._get_move_lines_of_packages_clause(move_lines)
+        self.env.cr.execute(
+            """
+            SELECT package.id, move_line.product_id, move_line.lot_id, SUM(move_line.product_qty)
+            {from_clause}
+            GROUP BY package.id, move_line.product_id, move_line.lot_id
+            """.format(
+                from_clause=from_clause
+            ),
+            params,
+        )
+        return self._group_product_lot_quantities(self.env.cr.fetchall())
+
+    @api.model
+    def _group_product_lot_quantities(self, rows):
+        """Group (package id, product id, lot id, quantity) rows by package"""
+        res = {}
+        for package_id, product_id, lot_id, quantity in rows:
+            res.setdefault(package_id, {})[(product_id, lot_id)] = quantity
+        return res
 
     def _get_package_link_structure(self):
         """Get package link structure, in case not founded after specific search args,
         create a new one"""
-        PackageHierarchyLink = self.env["package.hierarchy.link"]
-
         self.ensure_one()
-        hierarchy_lines = PackageHierarchyLink.browse()
-        package = self
-        while package.parent_id:
-            parent_hierarchy_lines = PackageHierarchyLink.search(
-                [("child_id", "=", package.id), ("parent_id", "=", package.parent_id.id)], limit=1
-            )
-            if not parent_hierarchy_lines:
-                parent_hierarchy_lines = PackageHierarchyLink.create(
-                    {"child_id": package.id, "parent_id": package.parent_id.id}
-                )
-            hierarchy_lines = hierarchy_lines | parent_hierarchy_lines
-            package = package.parent_id
-        package_hierarchy_lines = PackageHierarchyLink.search(
-            [("child_id", "=", package.id), ("parent_id", "=", False)], limit=1
-        )
-        if not package_hierarchy_lines:
-            package_hierarchy_lines = PackageHierarchyLink.create(
-                {"child_id": package.id, "parent_id": False}
-            )
-        hierarchy_lines = hierarchy_lines | package_hierarchy_lines
-        return hierarchy_lines.ids
+        package_ids = [self.id] + self._get_ancestor_ids_map()[self.id]
+        chain = self.browse(package_ids)
+        return self.get_or_construct_hierarchies([chain])[tuple(package_ids)].ids
 
     def get_or_construct_hierarchy_from_packages(self):
         """Getting or Creating (if any of hierarchy nodes doesnt exist) all hierarchy links of
@@ -287,35 +1027,91 @@ class QuantPackage(models.Model):
 
         :return: recordset of package hierarchy links
         """
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        if not self:
+            return PackageHierarchyLink.browse()
+        return self.get_or_construct_hierarchies([self])[tuple(self.ids)]
+
+    @api.model
+    def get_or_construct_hierarchies(self, package_chains):
+        """Get or create the hierarchy links of many chains of packages at once.
+
+        Each chain is a recordset of packages ordered from the innermost package
+        to the outermost one, as for get_or_construct_hierarchy_from_packages.
+        The existing links of all chains are read with one query and the missing
+        ones are created together.
+
+        :return: dict mapping the tuple of package ids of each chain to the
+            recordset of its package hierarchy links
+        """
         # Setting self to sudo to over pass access rights at this moment, have to be reviewed later
         self = self.sudo()
         PackageHierarchyLink = self.env["package.hierarchy.link"]
 
-        # Empty recordset
-        package_hierarchies = PackageHierarchyLink.browse()
-        if not self.exists():
-            return package_hierarchies
-        # Looping in pairs through packages which are ordered
-        for package, parent_package in pairwise(self):
-            hierarchy_link = PackageHierarchyLink.search(
-                [("child_id", "=", package.id), ("parent_id", "=", parent_package.id)], limit=1
+        package_chains = [self.browse(chain.ids) for chain in package_chains]
+        existing_package_ids = set(self.union(*package_chains).exists().ids)
+
+        # Edges are (child id, parent id) pairs, with a False parent for the unlink
+        # of the outermost package of each chain
+        edges_by_chain = {}
+        for chain in package_chains:
+            edges = []
+            if existing_package_ids.intersection(chain.ids):
+                # Looping in pairs through packages which are ordered
+                edges.extend(
+                    (package.id, parent_package.id) for package, parent_package in pairwise(chain)
+                )
+                edges.append((chain[-1].id, False))
+            edges_by_chain[tuple(chain.ids)] = edges
+
+        link_ids = self._get_hierarchy_link_ids(
+            {edge for edges in edges_by_chain.values() for edge in edges}
+        )
+        missing_edges = list(
+            dict.fromkeys(
+                edge for edges in edges_by_chain.values() for edge in edges if edge not in link_ids
+            )
+        )
+        if missing_edges:
+            new_links = PackageHierarchyLink.create(
+                [
+                    {"child_id": child_id, "parent_id": parent_id}
+                    for child_id, parent_id in missing_edges
+                ]
             )
-            if not hierarchy_link:
-                hierarchy_link = PackageHierarchyLink.create({
-                    "child_id": package.id,
-                    "parent_id": parent_package.id
-                })
-            package_hierarchies |= hierarchy_link
-        # If is only one record in self will not enter in the loop and will
-        # need to find the unlink for self
-        if len(self) == 1:
-            parent_package = self
-        hierarchy_link = PackageHierarchyLink.search(
-                [("child_id", "=", parent_package.id), ("parent_id", "=", False)], limit=1
+            link_ids.update(zip(missing_edges, new_links.ids))
+
+        return {
+            chain_ids: PackageHierarchyLink.browse(
+                list(dict.fromkeys(link_ids[edge] for edge in edges))
             )
-        if not hierarchy_link:
-            hierarchy_link = PackageHierarchyLink.create({
-                "child_id": parent_package.id
-            })
-        package_hierarchies |= hierarchy_link
-        return package_hierarchies
+            for chain_ids, edges in edges_by_chain.items()
+        }
+
+    @api.model
+    def _get_hierarchy_link_ids(self, edges):
+        """Return a dict mapping those of the (child id, parent id) edges that have
+        a link to the id of the oldest such link, whatever its move lines"""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        if not edges:
+            return {}
+        PackageHierarchyLink.flush(["child_id", "parent_id"])
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT ON (child_id, parent_id) child_id, parent_id, id
+            FROM {table}
+            WHERE child_id IN %s
+            ORDER BY child_id, parent_id, id
+            """.format(
+                table=PackageHierarchyLink._table
+            ),
+            [tuple({child_id for child_id, parent_id in edges})],
+        )
+        res = {}
+        for child_id, parent_id, link_id in self.env.cr.fetchall():
+            edge = (child_id, parent_id or False)
+            if edge in edges:
+                res[edge] = link_id
+        return res
@@ -1,4 +1,4 @@
-from odoo import fields, models
+from odoo import api, fields, models, tools
 
 
 class StockWarehouse(models.Model):
@@ -13,3 +13,34 @@ class StockWarehouse(models.Model):
             "outer package."
         ),
     )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Extend create to invalidate the cached warehouses of each company"""
+        warehouses = super().create(vals_list)
+        self.clear_caches()
+        return warehouses
+
+    def write(self, vals):
+        """Extend write to invalidate the cached warehouses of each company"""
+        res = super().write(vals)
+        if "company_id" in vals or "active" in vals:
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        """Extend unlink to invalidate the cached warehouses of each company"""
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache("company_id")
+    def _get_company_warehouse_ids(self, company_id):
+        """Return the ids of the active warehouses of a company.
+
+        The result is cached per company until a warehouse is created, removed
+        or moved between companies.
+        """
+        Warehouse = self.sudo().with_context(active_test=True)
+        return tuple(Warehouse.search([("company_id", "=", company_id)]).ids)
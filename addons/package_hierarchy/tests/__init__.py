@@ -1,3 +1,5 @@
 """Package hierarchy tests"""
 
 from . import test_package_hierarchy
+from . import test_benchmarks
+from . import test_query_counts
@@ -2,6 +2,7 @@ from odoo.tests import common, tagged
 from odoo.fields import Datetime
 from datetime import timedelta
 from itertools import count
+import time
 
 @tagged('-at_install', 'post_install')
 class BaseHierarchy(common.SavepointCase):
@@ -38,6 +39,31 @@ class BaseHierarchy(common.SavepointCase):
         # Counter to ensure stock.quant are created in order
         cls.quant_counter = count()
 
+    def count_queries(self, func, *args, record_time=None, **kwargs):
+        """Return the number of SQL queries executed by calling func.
+
+        Pending writes are flushed and the cache is cleared beforehand so
+        that only the queries issued by func itself are counted. When given,
+        record_time is called with the wall time of func alone, in seconds.
+        """
+        self.env["base"].flush()
+        self.env["base"].invalidate_cache()
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        query_count = self.env.cr.sql_log_count - query_count
+        if record_time:
+            record_time(elapsed)
+        return query_count
+
+    def assert_batch_query_count(self, records, method_name, *args, batch_size=2):
+        """Assert that calling method_name on all of records issues as many
+        queries as calling it on the first batch_size of them."""
+        few_count = self.count_queries(getattr(records[:batch_size], method_name), *args)
+        all_count = self.count_queries(getattr(records, method_name), *args)
+        self.assertEqual(few_count, all_count)
+
     @classmethod
     def create_move_line(cls, move, qty, **kwargs):
         """Create and return a move line for the given move and qty."""
@@ -108,3 +134,26 @@ class BaseHierarchy(common.SavepointCase):
         #Ensure quants are reserved in order of creation
         vals.setdefault("in_date", Datetime.now() + timedelta(0, next(cls.quant_counter)))
         return Quant.create(vals)
+
+    @classmethod
+    def create_package_hierarchy(
+        cls, product, location, num_pallets, branching=2, depth=2, quants_per_leaf=1, qty=1
+    ):
+        """Create num_pallets package trees of the given depth, where each package
+        above the bottom level contains branching packages, and each package of
+        the bottom level contains quants_per_leaf quants of qty of product.
+
+        Return the pallets and the packages of the bottom level.
+        """
+        Package = cls.env["stock.quant.package"]
+
+        pallets = Package.create([{} for i in range(num_pallets)])
+        leaves = pallets
+        for level in range(depth - 1):
+            leaves = Package.create(
+                [{"parent_id": parent.id} for parent in leaves for i in range(branching)]
+            )
+        for leaf in leaves:
+            for i in range(quants_per_leaf):
+                cls.create_quant(product.id, location.id, qty, package_id=leaf.id)
+        return pallets, leaves
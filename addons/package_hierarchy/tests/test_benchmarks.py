@@ -0,0 +1,165 @@
+"""Benchmarks of odoo-package-hierarchy
+
+These are not run with the standard tests, run them with
+``--test-tags package_hierarchy_benchmark``.
+"""
+
+import logging
+import time
+
+from odoo.tests.common import BaseCase, tagged
+
+from . import common
+from ..models.link_graph import LinkGraph, PackageLoopError
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged("-standard", "package_hierarchy_benchmark")
+class TestLinkGraphBenchmark(BaseCase):
+    """Benchmarks of building chains from large numbers of links."""
+
+    def make_links(self, num_links, chain_length=4):
+        """Return link triples forming chains of chain_length packages, along
+        with an unlink for the innermost package of each chain"""
+        links = []
+        link_id = 0
+        package_id = 0
+        while len(links) < num_links:
+            chain_ids = range(package_id + 1, package_id + chain_length + 1)
+            package_id += chain_length
+            for child_id, parent_id in zip(chain_ids, chain_ids[1:]):
+                link_id += 1
+                links.append((link_id, parent_id, child_id))
+            link_id += 1
+            links.append((link_id, False, chain_ids[0]))
+        return links[:num_links]
+
+    def test_link_graph_chains(self):
+        """Chain construction scales linearly with the number of links"""
+        timings = {}
+        for num_links in (10000, 50000, 100000):
+            links = self.make_links(num_links)
+            start = time.perf_counter()
+            graph = LinkGraph(links)
+            graph.check_children()
+            chains = graph.chains(4)
+            timings[num_links] = time.perf_counter() - start
+            _logger.info(
+                "Built %d chains from %d links in %.3fs",
+                len(chains),
+                num_links,
+                timings[num_links],
+            )
+            self.assertEqual(
+                sum(len(chain) - 1 for chain in chains),
+                sum(1 for _link_id, parent_id, _child_id in links if parent_id),
+            )
+        # Allow for generous noise, a quadratic algorithm would be ~100x slower
+        self.assertLess(timings[100000], timings[10000] * 30 + 0.5)
+
+    def test_link_graph_loop(self):
+        """Loops are found in a large number of links"""
+        links = self.make_links(100000)
+        # Close the first chain into a loop
+        links.append((len(links) + 1, 1, 4))
+        with self.assertRaises(PackageLoopError):
+            LinkGraph(links).chains(4)
+
+
+@tagged("-standard", "package_hierarchy_benchmark")
+class TestPackageHierarchyBenchmark(common.BaseHierarchy):
+    """Benchmarks of the hot paths of package hierarchies over a synthetic warehouse.
+
+    The size of the warehouse is set by the class attributes, the wall time and
+    number of queries of each benchmark are logged to track them between releases.
+    """
+
+    NUM_PALLETS = 20
+    BRANCHING = 3
+    DEPTH = 3
+    QUANTS_PER_LEAF = 2
+    MOVE_LINES_PER_PICKING = 30
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env.user.get_user_warehouse().write({"x_max_package_depth": cls.DEPTH + 1})
+        cls.pallets, cls.leaves = cls.create_package_hierarchy(
+            cls.apple,
+            cls.test_location_01,
+            cls.NUM_PALLETS,
+            branching=cls.BRANCHING,
+            depth=cls.DEPTH,
+            quants_per_leaf=cls.QUANTS_PER_LEAF,
+        )
+
+    def benchmark(self, name, func, *args, **kwargs):
+        """Call func and log its wall time and number of queries"""
+        timings = []
+        query_count = self.count_queries(func, *args, record_time=timings.append, **kwargs)
+        _logger.info(
+            "%s: %.3fs, %d queries (%d pallets, branching %d, depth %d, %d quants per leaf)",
+            name,
+            timings[0],
+            query_count,
+            self.NUM_PALLETS,
+            self.BRANCHING,
+            self.DEPTH,
+            self.QUANTS_PER_LEAF,
+        )
+
+    def create_reserved_picking(self):
+        """Create a picking reserving MOVE_LINES_PER_PICKING quants, in the order in
+        which they were created, to be moved to the second test location"""
+        picking = self.create_picking(
+            self.picking_type_internal, location_dest_id=self.test_location_02.id
+        )
+        self.create_move(self.apple, self.MOVE_LINES_PER_PICKING, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        return picking
+
+    def test_compute_aggregated_quant_ids(self):
+        """Aggregate the quants of every pallet"""
+        self.benchmark("_compute_aggregated_quant_ids", self.pallets._compute_aggregated_quant_ids)
+
+    def test_is_fulfilled_by(self):
+        """Check every pallet against the move lines of a picking"""
+        picking = self.create_reserved_picking()
+        move_lines = picking.move_line_ids
+        self.benchmark(
+            "is_fulfilled_by",
+            lambda: [pallet.is_fulfilled_by(move_lines) for pallet in self.pallets],
+        )
+
+    def test_validate_links(self):
+        """Validate links moving the contents of every pallet to another pallet"""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        # Move the packages below each pallet to the next pallet
+        boxes = self.pallets.child_ids
+        vals = []
+        for pallet, next_pallet in zip(self.pallets, self.pallets[1:] + self.pallets[:1]):
+            for box in pallet.child_ids:
+                vals.append({"parent_id": False, "child_id": box.id})
+                vals.append({"parent_id": next_pallet.id, "child_id": box.id})
+        links = PackageHierarchyLink.create(vals)
+        self.assertEqual(len(links.child_id), len(boxes))
+        self.benchmark("_validate_links", links._validate_links)
+
+    def test_construct_package_hierarchy_links(self):
+        """Construct the links of the move lines of a picking"""
+        picking = self.create_reserved_picking()
+        self.benchmark(
+            "construct_package_hierarchy_links",
+            picking.move_line_ids.construct_package_hierarchy_links,
+        )
+
+    def test_action_done(self):
+        """Complete the move lines of a picking"""
+        picking = self.create_reserved_picking()
+        for move_line in picking.move_line_ids:
+            move_line.qty_done = move_line.product_uom_qty
+        self.benchmark("_action_done", picking._action_done)
+        self.assertEqual(picking.state, "done")
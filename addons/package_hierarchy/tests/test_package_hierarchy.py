@@ -1,8 +1,16 @@
 """Test odoo-package-hierarchy"""
 
+import importlib.util
+import os
+from unittest.mock import patch
+
+from psycopg2 import errorcodes
+
 from odoo.exceptions import ValidationError
 
 from . import common
+from ..models.package_links import DuplicateLinkConflict
+from ..models.deferred_checks import DEFER_CONTEXT_KEY, run_deferred_checks
 
 # Note that quant actually is being used; action_assign finds it.
 class TestPackageHierarchy(common.BaseHierarchy):
@@ -73,6 +81,112 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertEqual(self.package.x_depth, 2)
         self.assertEqual(box.x_depth, 1)
 
+    def test_reparent_query_count(self):
+        """Test that moving a pallet does not cost more queries as its contents grow."""
+        Package = self.env["stock.quant.package"]
+
+        def build_pallet(num_cartons):
+            pallet = Package.create({})
+            Package.create([{"parent_id": pallet.id} for i in range(num_cartons)])
+            return pallet
+
+        trailer = Package.create({})
+        small_pallet = build_pallet(2)
+        large_pallet = build_pallet(20)
+        small_count = self.count_queries(small_pallet.write, {"parent_id": trailer.id})
+        large_count = self.count_queries(large_pallet.write, {"parent_id": trailer.id})
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(trailer.x_depth, 3)
+        self.assertEqual(large_pallet.child_ids.x_top_parent_id, trailer)
+
+    def test_user_warehouse_cache_invalidated(self):
+        """Test that the cached warehouse of the user's company is refreshed
+        when a warehouse is added to the company."""
+        Warehouse = self.env["stock.warehouse"]
+
+        # The warehouse created below is rolled back after the test, make sure
+        # it does not linger in the cache
+        self.addCleanup(Warehouse.clear_caches)
+        self.assertEqual(self.env.user.get_user_max_package_depth(), 4)
+        Warehouse.create(
+            {"name": "Second warehouse", "code": "WH2", "company_id": self.env.company.id}
+        )
+        with self.assertRaises(ValidationError):
+            self.env.user.get_user_warehouse()
+
+    def test_parent_path(self):
+        """Test that the materialised path is maintained when packages are moved."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({})
+        box.parent_id = self.package
+        self.package.parent_id = self.pallet
+        self.assertEqual(self.pallet.parent_path, "%d/" % self.pallet.id)
+        self.assertEqual(
+            box.parent_path, "%d/%d/%d/" % (self.pallet.id, self.package.id, box.id)
+        )
+        self.package.parent_id = False
+        self.assertEqual(box.parent_path, "%d/%d/" % (self.package.id, box.id))
+
+    def test_set_parents(self):
+        """Test that packages are moved in bulk with their hierarchy fields maintained."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        crate = Package.create({})
+        moved = Package._set_parents(
+            {self.package.id: self.pallet.id, crate.id: self.pallet.id, box.id: self.package.id}
+        )
+        # The box was already in the package
+        self.assertEqual(moved, self.package | crate)
+        self.assertEqual(self.pallet.child_ids, self.package | crate)
+        self.assertEqual(
+            box.parent_path, "%d/%d/%d/" % (self.pallet.id, self.package.id, box.id)
+        )
+        self.assertEqual((self.package | crate | box).x_top_parent_id, self.pallet)
+        self.assertEqual(self.pallet.x_depth, 3)
+        self.assertEqual(self.pallet.location_id, self.test_location_01)
+
+        Package._set_parents({self.package.id: False})
+        self.assertEqual(box.parent_path, "%d/%d/" % (self.package.id, box.id))
+        self.assertEqual(box.x_top_parent_id, self.package)
+        self.assertEqual(self.pallet.x_depth, 2)
+        # The former parent no longer holds the contents of the package
+        self.assertFalse(self.pallet.location_id)
+
+        with self.assertRaises(ValidationError):
+            Package._set_parents({self.package.id: box.id})
+        # The loop was found before anything was changed
+        box.invalidate_cache()
+        self.assertEqual(box.parent_path, "%d/%d/" % (self.package.id, box.id))
+        self.assertFalse(self.package.parent_id)
+
+    def test_get_top_packages(self):
+        """Test that the outermost package of each tree is returned once."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        self.package.parent_id = self.pallet
+        crate = Package.create({})
+        packages = box | self.package | self.pallet | crate
+        self.assertEqual(packages._get_top_packages(), self.pallet | crate)
+
+    def test_quant_top_package(self):
+        """Test that the outermost package of quants is maintained as quants and
+        packages are moved."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5, package_id=box.id)
+        self.assertEqual(quant.x_top_package_id, self.package)
+        self.package.parent_id = self.pallet
+        self.assertEqual(quant.x_top_package_id, self.pallet)
+        self.assertIn(quant, self.pallet.x_aggregated_quant_ids)
+        box.parent_id = False
+        self.assertEqual(quant.x_top_package_id, box)
+        quant.package_id = False
+        self.assertFalse(quant.x_top_package_id)
+
     def test_check_not_multi_location(self):
         """Test that the happy case where quants are in the same location
         doesn't raise an exception."""
@@ -131,6 +245,24 @@ class TestPackageHierarchy(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             subpackage2.parent_id = package2
 
+    def test_get_multi_location_package_ids(self):
+        """Make sure only packages whose contents span several locations are returned."""
+        Package = self.env["stock.quant.package"]
+        Quant = self.env["stock.quant"]
+
+        package2 = Package.create({"parent_id": self.pallet.id})
+        self.package.parent_id = self.pallet
+        Quant.with_context(bypass_quant_multi_loc_checks=True).create(
+            {
+                "product_id": self.apple.id,
+                "location_id": self.test_location_02.id,
+                "quantity": 1,
+                "package_id": package2.id,
+            }
+        )
+        packages = self.pallet | self.package | package2
+        self.assertEqual(packages._get_multi_location_package_ids(), [self.pallet.id])
+
     def test_return_num_ancestors(self):
         """Test that the correct number of ancestors is calculated"""
         Package = self.env["stock.quant.package"]
@@ -153,6 +285,57 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertEqual(self.package._return_ancestors(), self.pallet)
         self.assertEqual(box._return_ancestors(), self.package + self.pallet)
 
+    def test_ancestor_and_descendant_maps(self):
+        """Test that the batch ancestor/descendant maps cover the whole recordset."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({})
+        box.parent_id = self.package
+        self.package.parent_id = self.pallet
+        packages = box | self.package | self.pallet
+        self.assertEqual(
+            packages._get_ancestor_ids_map(),
+            {
+                box.id: [self.package.id, self.pallet.id],
+                self.package.id: [self.pallet.id],
+                self.pallet.id: [],
+            },
+        )
+        self.assertEqual(
+            packages._get_num_ancestors_map(),
+            {box.id: 2, self.package.id: 1, self.pallet.id: 0},
+        )
+        self.assertEqual(
+            packages._get_descendant_ids_map(),
+            {
+                box.id: [],
+                self.package.id: [box.id],
+                self.pallet.id: [self.package.id, box.id],
+            },
+        )
+
+    def test_load_package_tree(self):
+        """Test that the snapshot of a package tree includes the ancestors of the
+        packages and the contents of the subtree packages, but not the rest of
+        the tree."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        self.package.parent_id = self.pallet
+        other_box = Package.create({"parent_id": self.pallet.id})
+        other_pallet = Package.create({})
+
+        tree = box._load_package_tree()
+        self.assertEqual(set(tree.nodes), {self.pallet.id, self.package.id, box.id})
+        self.assertNotIn(other_box.id, tree)
+        self.assertNotIn(other_pallet.id, tree)
+        self.assertEqual(tree.nodes[box.id].parent_id, self.package.id)
+        self.assertEqual(tree.nodes[self.package.id].parent_id, self.pallet.id)
+        self.assertFalse(tree.nodes[self.pallet.id].parent_id)
+
+        tree = other_pallet._load_package_tree(subtree_packages=self.package)
+        self.assertEqual(set(tree.nodes), {other_pallet.id, self.package.id, box.id})
+
     def test_aggregated_quant_ids(self):
         """Make sure _compute_aggregated_quant_ids includes child package quants and
            excludes zero quantity/reserved_quantity quants"""
@@ -202,6 +385,17 @@ class TestPackageHierarchy(common.BaseHierarchy):
             [self.quant.id, box_quant.id, box_child_quant.id],
         )
 
+    def test_aggregated_quant_ids_query_count(self):
+        """Make sure _compute_aggregated_quant_ids issues the same number of queries
+        regardless of the number of packages being computed"""
+        pallets, boxes = self.create_package_hierarchy(
+            self.apple, self.test_location_01, 10, branching=1
+        )
+
+        self.assert_batch_query_count(pallets, "_compute_aggregated_quant_ids")
+        for pallet, box in zip(pallets, boxes):
+            self.assertEqual(pallet.x_aggregated_quant_ids, box.quant_ids)
+
     def test_compute_package_info(self):
         """Make sure _compute_package_info runs on both packages and pallets."""
         # This just runs the code for coverage. Checking the logic would only
@@ -210,6 +404,26 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.package.parent_id = self.pallet
         self.pallet._compute_package_info()
 
+    def test_compute_package_info_query_count(self):
+        """Make sure _compute_package_info issues the same number of queries
+        regardless of the number of packages being computed"""
+        Package = self.env["stock.quant.package"]
+
+        pallets, boxes = self.create_package_hierarchy(
+            self.apple, self.test_location_01, 10, branching=1
+        )
+
+        self.assert_batch_query_count(pallets, "_compute_package_info")
+        self.assertEqual(pallets.location_id, self.test_location_01)
+        self.assertEqual(boxes.location_id, self.test_location_01)
+
+        # Empty quants do not count towards the contents of the package
+        box = Package.create({})
+        self.create_quant(self.apple.id, self.test_location_02.id, 0, package_id=box.id)
+        self.create_quant(self.apple.id, self.test_location_01.id, 1, package_id=box.id)
+        box._compute_package_info()
+        self.assertEqual(box.location_id, self.test_location_01)
+
     def test_compute_display_name(self):
         """Make sure _compute_display_name runs on both packages and pallets."""
         self.package._compute_display_name()
@@ -257,9 +471,51 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.picking.move_line_ids[0].result_package_id = self.package
         self.assertEqual(self.package.get_move_lines_of_children(), self.picking.move_line_ids[0])
 
+    def test_iter_contained_quants(self):
+        """Test that contained quants are iterated over in pages ordered by id"""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        quants = self.package.quant_ids
+        for qty in range(1, 4):
+            quants |= self.create_quant(
+                self.banana.id, self.test_location_01.id, qty, package_id=box.id
+            )
+        pages = list(self.package.iter_contained_quants(page_size=2))
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertEqual(
+            [quant.id for page in pages for quant in page], sorted(quants.ids)
+        )
+        banana_quants = self.package.iter_contained_quants([("product_id", "=", self.banana.id)])
+        self.assertEqual(next(banana_quants), quants.filtered(lambda q: q.product_id == self.banana))
+
+    def test_iter_move_lines_of_children(self):
+        """Test that the move lines of contained packages are iterated over in pages
+        ordered by id"""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({"parent_id": self.package.id})
+        other_box = Package.create({})
+        picking = self.create_picking(self.picking_type_internal)
+        move = self.create_move(self.banana, 5, picking)
+        move_lines = self.create_move_line(move, 1, result_package_id=self.package.id)
+        for i in range(3):
+            move_lines |= self.create_move_line(move, 1, package_id=box.id)
+        # Not within the package
+        self.create_move_line(move, 1, package_id=other_box.id)
+
+        pages = list(self.package.iter_move_lines_of_children(page_size=2))
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertEqual(
+            [move_line.id for page in pages for move_line in page], sorted(move_lines.ids)
+        )
+        box_move_lines = self.package.iter_move_lines_of_children([("package_id", "=", box.id)])
+        self.assertEqual(next(box_move_lines), move_lines.filtered(lambda ml: ml.package_id == box))
+
     def test_action_view_picking_domain(self):
         """Make sure the domain from the view picking action is correct"""
         Package = self.env["stock.quant.package"]
+        Picking = self.env["stock.picking"]
 
         box = Package.create({})
         box.parent_id = self.package
@@ -282,14 +538,22 @@ class TestPackageHierarchy(common.BaseHierarchy):
         action_res = self.package.action_view_picking()
         domain = action_res.get("domain", [])
 
-        domain_first_arg = domain[0]
-        domain_first_arg_field = domain_first_arg[0]
-        domain_first_arg_operator = domain_first_arg[1]
-        domain_first_arg_value = domain_first_arg[2]
+        self.assertEqual(domain, [("x_hierarchy_package_ids", "in", self.package.ids)])
+        self.assertEqual(Picking.search(domain), picking2 | self.picking)
 
-        self.assertEqual(domain_first_arg_field, "id")
-        self.assertEqual(domain_first_arg_operator, "in")
-        self.assert_lists_are_equivalent(domain_first_arg_value, [picking2.id, self.picking.id])
+    def test_product_quantities_by_key(self):
+        """Test that quantities grouped by field names match those grouped by a callable"""
+        self.package.parent_id = self.pallet
+        self.create_quant(self.apple.id, self.test_location_01.id, 5, package_id=self.pallet.id)
+        self.create_quant(self.banana.id, self.test_location_01.id, 2, package_id=self.pallet.id)
+
+        expected = {self.apple: 15, self.banana: 2}
+        self.assertEqual(self.pallet.product_quantities_by_key(), expected)
+        self.assertEqual(self.pallet.product_quantities_by_key(lambda q: q.product_id), expected)
+        self.assertEqual(
+            self.pallet.product_quantities_by_key(("product_id", "lot_id")),
+            self.pallet.product_quantities_by_key(lambda q: (q.product_id, q.lot_id)),
+        )
 
     def test_is_fulfilled_by(self):
         """Test that is_fulfilled_by correctly identifies packages fulfilled
@@ -330,6 +594,22 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.quant.quantity += 2
         self.assertFalse(self.package.is_fulfilled_by(self.picking.move_line_ids))
 
+    def test_filter_fulfilled_by(self):
+        """Test that filter_fulfilled_by returns the packages that are each
+        fulfilled by the move lines."""
+        Package = self.env["stock.quant.package"]
+
+        box = Package.create({})
+        self.create_quant(self.banana.id, self.test_location_01.id, 3, package_id=box.id)
+        self.package.parent_id = self.pallet
+        packages = self.package | self.pallet | box
+        move_lines = self.picking.move_line_ids
+        self.assertEqual(packages.filter_fulfilled_by(move_lines), self.package | self.pallet)
+        self.assertEqual(
+            packages.filter_fulfilled_by(move_lines),
+            packages.filtered(lambda p: p.is_fulfilled_by(move_lines)),
+        )
+
     def test_assert_moveline_link_not_created(self):
         """Assert package links not created when not unlinking"""
         Package = self.env["stock.quant.package"]
@@ -373,6 +653,20 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertEqual(boxes.location_id, self.test_location_02)
         self.assertEqual(boxes.parent_id, pallet)
 
+    def test_action_done_keeps_outer_deferred_checks(self):
+        """Test that checks deferred by the caller of _action_done stay queued until
+        the caller runs them."""
+        Package = self.env["stock.quant.package"].with_context(**{DEFER_CONTEXT_KEY: True})
+
+        packages = Package.create([{} for i in range(5)])
+        for package, parent in zip(packages[1:], packages):
+            package.write({"parent_id": parent.id})
+        move_lines = self.picking.move_line_ids.with_context(**{DEFER_CONTEXT_KEY: True})
+        move_lines.qty_done = 10
+        move_lines._action_done()
+        with self.assertRaises(ValidationError):
+            run_deferred_checks(self.env)
+
     def test_action_done_partial(self):
         """Test that action done works as expected with package hierarchies
         when moving a combination of an entire package out of a parent package and
@@ -405,6 +699,38 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertFalse(box1.parent_id)
         self.assertEqual(box2.parent_id, pallet)
 
+    def test_links_of_picking_validated_together(self):
+        """Test that links are stored against the transfer of their move lines,
+        and are validated together with the other links of the transfer."""
+        Package = self.env["stock.quant.package"]
+        PackageLink = self.env["package.hierarchy.link"]
+
+        box = Package.create({})
+        pallets = Package.create([{}, {}])
+        picking = self.create_picking(self.picking_type_internal)
+        apple_move = self.create_move(self.apple, 1, picking)
+        banana_move = self.create_move(self.banana, 1, picking)
+        apple_move_line = self.create_move_line(apple_move, 1)
+        banana_move_line = self.create_move_line(banana_move, 1)
+
+        link = PackageLink.create(
+            {
+                "parent_id": pallets[0].id,
+                "child_id": box.id,
+                "move_line_ids": [(6, 0, apple_move_line.ids)],
+            }
+        )
+        self.assertEqual(link.picking_id, picking)
+        # A link of another move of the transfer moving the box elsewhere is rejected
+        with self.assertRaises(ValidationError):
+            PackageLink.create(
+                {
+                    "parent_id": pallets[1].id,
+                    "child_id": box.id,
+                    "move_line_ids": [(6, 0, banana_move_line.ids)],
+                }
+            )
+
     def test_duplicate_link_creation(self):
         """
         Test when creating a duplicate link,
@@ -441,6 +767,87 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertEqual((link1 == link2), False)
         with self.assertRaises(ValidationError):
             link2.write({"parent_id": box1.id, "child_id": box2.id})
+        # The failed write was rolled back, leaving the transaction usable
+        link2.invalidate_cache()
+        self.assertEqual(link2.parent_id, box3)
+        link2.write({"parent_id": box1.id})
+        self.assertEqual(link2.parent_id, box1)
+
+    def test_duplicate_link_creation_conflict(self):
+        """
+        Test that when a duplicate link is committed by another transaction, which
+        this transaction cannot see, a serialization failure is raised so that the
+        transaction is retried, and no link is created
+        """
+        Package = self.env["stock.quant.package"]
+        PackageLink = self.env["package.hierarchy.link"]
+        box1 = Package.create({})
+        box2 = Package.create({})
+        box3 = Package.create({})
+        link1 = PackageLink.create({"parent_id": box1.id, "child_id": box2.id})
+
+        # Pretend the link was committed by another transaction, hidden from this one
+        with patch.object(type(PackageLink), "_get_existing_link_ids", return_value={}):
+            with self.assertRaises(DuplicateLinkConflict) as e:
+                PackageLink.create(
+                    [
+                        {"parent_id": box1.id, "child_id": box2.id},
+                        {"parent_id": box1.id, "child_id": box3.id},
+                    ]
+                )
+        self.assertEqual(e.exception.pgcode, errorcodes.SERIALIZATION_FAILURE)
+        self.assertEqual(PackageLink.search([("child_id", "in", (box2 | box3).ids)]), link1)
+
+    def test_duplicate_link_creation_defaults(self):
+        """
+        Test that duplicates are found when the move lines of the link come from
+        the context defaults
+        """
+        Package = self.env["stock.quant.package"]
+        PackageLink = self.env["package.hierarchy.link"]
+        box1 = Package.create({})
+        box2 = Package.create({})
+        move_line = self.picking.move_line_ids[0]
+        link1 = PackageLink.create(
+            {
+                "parent_id": box1.id,
+                "child_id": box2.id,
+                "move_line_ids": [(4, move_line.id)],
+            }
+        )
+        link2 = PackageLink.with_context(default_move_line_ids=[(4, move_line.id)]).create(
+            {"parent_id": box1.id, "child_id": box2.id}
+        )
+        self.assertEqual(link1, link2)
+
+    def test_remove_duplicate_links_migration(self):
+        """Test that the migration removing duplicate links keeps the oldest link"""
+        Package = self.env["stock.quant.package"]
+        PackageLink = self.env["package.hierarchy.link"]
+        box1 = Package.create({})
+        box2 = Package.create({})
+        link1 = PackageLink.create({"parent_id": box1.id, "child_id": box2.id})
+        # Duplicates could only be inserted before the signature was stored
+        self.env.cr.execute(
+            """
+            INSERT INTO package_hierarchy_link (parent_id, child_id, company_id)
+            SELECT parent_id, child_id, company_id FROM package_hierarchy_link WHERE id = %s
+            RETURNING id
+            """,
+            [link1.id],
+        )
+        duplicate_id = self.env.cr.fetchone()[0]
+
+        path = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "migrations", "11.2", "pre-migrate.py"
+        )
+        spec = importlib.util.spec_from_file_location("pre_migrate", path)
+        migration = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(migration)
+        migration.migrate(self.env.cr, "11.1")
+
+        self.assertTrue(link1.exists())
+        self.assertFalse(PackageLink.browse(duplicate_id).exists())
 
 
 
@@ -507,6 +914,37 @@ class TestPackageInheritance(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             self.package_d.write({"parent_id": self.package_c.id})
 
+    def test_deferred_max_package_depth(self):
+        """Test that deferred depth checks are only raised once the deferred checks are run."""
+        deferred_packages = (self.package_b | self.package_c | self.package_d).with_context(
+            **{DEFER_CONTEXT_KEY: True}
+        )
+        deferred_packages[0].write({"parent_id": self.package_a.id})
+        deferred_packages[1].write({"parent_id": self.package_b.id})
+        deferred_packages[2].write({"parent_id": self.package_c.id})
+        with self.assertRaises(ValidationError):
+            run_deferred_checks(self.env)
+
+    def test_deferred_checks_kept_while_creating_links(self):
+        """Test that creating and writing links does not run the deferred checks."""
+        Package = self.env["stock.quant.package"]
+        PackageLink = self.env["package.hierarchy.link"].with_context(
+            **{DEFER_CONTEXT_KEY: True}
+        )
+
+        deferred_packages = (self.package_b | self.package_c | self.package_d).with_context(
+            **{DEFER_CONTEXT_KEY: True}
+        )
+        deferred_packages[0].write({"parent_id": self.package_a.id})
+        deferred_packages[1].write({"parent_id": self.package_b.id})
+        deferred_packages[2].write({"parent_id": self.package_c.id})
+        box1 = Package.create({})
+        box2 = Package.create({})
+        link = PackageLink.create({"parent_id": box1.id, "child_id": box2.id})
+        link.write({"parent_id": False})
+        with self.assertRaises(ValidationError):
+            run_deferred_checks(self.env)
+
 
 class TestPackageHierarchyLinks(common.BaseHierarchy):
     """Tests for package hierarchy links."""
@@ -581,6 +1019,27 @@ class TestPackageHierarchyLinks(common.BaseHierarchy):
         self.assertEqual(len(package_b_unlinks), 1)
         self.assertEqual(package_b_unlinks.move_line_ids[0].id, move_line2.id)
 
+    def test_create_links_batch(self):
+        """Make sure a batch of links reuses existing links and duplicates within the batch"""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        existing_link = PackageHierarchyLink.create(
+            {"parent_id": self.package_e.id, "child_id": self.package_f.id}
+        )
+        vals = [
+            {"parent_id": self.package_c.id, "child_id": self.package_e.id},
+            {"parent_id": self.package_e.id, "child_id": self.package_f.id},
+            {"parent_id": self.package_c.id, "child_id": self.package_e.id},
+            {"parent_id": False, "child_id": self.package_d.id},
+        ]
+        links = PackageHierarchyLink.create(vals)
+        self.assertEqual(len(links), 4)
+        self.assertEqual(links[1], existing_link)
+        self.assertEqual(links[0], links[2])
+        self.assertEqual(len(links | existing_link), 3)
+        self.assertEqual(links[3].child_id, self.package_d)
+        self.assertFalse(links[3].parent_id)
+
     def test_create_hierarchy_from_packages(self):
         """Make sure that get_or_construct_hierarchy_from_packages works as expected"""
         Package = self.env["stock.quant.package"]
@@ -616,6 +1075,29 @@ class TestPackageHierarchyLinks(common.BaseHierarchy):
         self.assertEqual(len(new_hierarchy_links), 4)
         self.assertTrue(set(hierarchy_links) <= set(new_hierarchy_links))
 
+    def test_get_or_construct_hierarchies(self):
+        """Make sure links of several chains are got or created in one call"""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        existing_link = PackageHierarchyLink.create(
+            {"child_id": self.package_d.id, "parent_id": self.package_b.id}
+        )
+        chain1 = self.package_d | self.package_b
+        chain2 = self.package_e | self.package_f
+        hierarchies = self.env["stock.quant.package"].get_or_construct_hierarchies(
+            [chain1, chain2]
+        )
+        self.assertEqual(set(hierarchies), {tuple(chain1.ids), tuple(chain2.ids)})
+        links1 = hierarchies[tuple(chain1.ids)]
+        links2 = hierarchies[tuple(chain2.ids)]
+        self.assertEqual(links1[0], existing_link)
+        self.assertEqual(links1[1].child_id, self.package_b)
+        self.assertFalse(links1[1].parent_id)
+        self.assertEqual(links2[0].child_id, self.package_e)
+        self.assertEqual(links2[0].parent_id, self.package_f)
+        self.assertEqual(links2[1].child_id, self.package_f)
+        self.assertFalse(links2[1].parent_id)
+
     def test_compute_name(self):
         """Make sure the package link name is correctly computed"""
         PackageHierarchyLink = self.env["package.hierarchy.link"]
@@ -738,6 +1220,29 @@ class TestPackageHierarchyLinks(common.BaseHierarchy):
         self.assertEqual(len(unlinks), 2)
         self.assertEqual(self.package_a + self.package_e, children)
 
+    def test_create_unlinks_batch(self):
+        """Make sure that the unlinks of many packages are created with the move lines
+        acting on each package, finding the move lines in the same number of queries
+        regardless of the number of packages"""
+        Package = self.env["stock.quant.package"]
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        picking = self.create_picking(self.picking_type_internal)
+        move = self.create_move(self.apple, 6, picking)
+        boxes = Package.create([{"parent_id": self.package_a.id} for i in range(3)])
+        move_lines = self.env["stock.move.line"]
+        for box in boxes:
+            self.create_quant(self.apple.id, self.test_location_01.id, 2, package_id=box.id)
+            move_lines |= self.create_move_line(move, 2, package_id=box.id)
+
+        self.assert_batch_query_count(boxes, "_get_move_line_ids_map", move_lines, batch_size=1)
+
+        unlinks = PackageHierarchyLink.create_unlinks(boxes, move_lines)
+        self.assertEqual(unlinks.child_id, boxes)
+        self.assertFalse(unlinks.parent_id)
+        for unlink in unlinks:
+            self.assertEqual(unlink.move_line_ids.package_id, unlink.child_id)
+
     def test_return_chains(self):
         """Tests that chains are constructed correctly."""
         PackageHierarchyLink = self.env["package.hierarchy.link"]
@@ -786,6 +1291,24 @@ class TestPackageHierarchyLinks(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             combined_links._return_chains()
 
+    def test_return_chains_multiple_parents(self):
+        """Tests that a package linked to several parents is not left out of the chains."""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        self.package_b.parent_id = False
+        self.package_c.parent_id = False
+        # Need to create invalid links in 2 parts or they will (correctly)
+        # raise validation errors on creation.
+        link = PackageHierarchyLink.create(
+            {"parent_id": self.package_a.id, "child_id": self.package_c.id}
+        )
+        other_link = PackageHierarchyLink.create(
+            {"parent_id": self.package_b.id, "child_id": self.package_c.id}
+        )
+        combined_links = link + other_link
+        with self.assertRaises(ValidationError):
+            combined_links._return_chains()
+
     def test_return_chains_maximum_length(self):
         """Tests that we cannot construct chains that are longer than the maximum depth"""
         PackageHierarchyLink = self.env["package.hierarchy.link"]
@@ -977,6 +1500,28 @@ class TestPackageHierarchyLinksValidation(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             PackageHierarchyLink.create(vals)
 
+    def test_validate_links_maximum_length_multiple_chains(self):
+        """Make sure that separate chains acting on the same tree are checked together.
+        - Chains package1 > package4 and package3 > pallet are each within the maximum depth
+        - Together they result in package3 > pallet > package1 > package4
+        """
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        vals = [
+            {"parent_id": self.package1.id, "child_id": self.package4.id},
+            {"parent_id": self.package3.id, "child_id": self.pallet.id},
+        ]
+        with self.assertRaises(ValidationError), self.env.cr.savepoint():
+            PackageHierarchyLink.create(vals)
+
+        # Removing package1 from the pallet at the same time keeps both trees valid.
+        # The unlink already exists, it is validated along with the new links.
+        links = PackageHierarchyLink.create(
+            vals + [{"parent_id": False, "child_id": self.package1.id}]
+        )
+        self.assertEqual(len(links), 3)
+        self.assertEqual(links[2], self.unlink)
+
     def test_validate_links_self_ancestor_existing_hierarchy(self):
         """Make sure that links do not cause self-ancestors with existing hierarchy."""
         PackageHierarchyLink = self.env["package.hierarchy.link"]
@@ -0,0 +1,131 @@
+"""Query count regression tests of odoo-package-hierarchy
+
+Each hot path is run over batches of increasing size, of package trees of
+increasing size, and must not issue more queries for the larger batches than
+for the smallest one.
+"""
+
+from itertools import count
+
+from odoo.tests import tagged
+
+from . import common
+
+
+@tagged("package_hierarchy_query_count")
+class TestQueryCounts(common.BaseHierarchy):
+    """Tests that the hot paths do not scale with the size of package trees."""
+
+    SIZES = (1, 3, 9)
+
+    def setUp(self):
+        super().setUp()
+        self.env.user.get_user_warehouse().write({"x_max_package_depth": 4})
+        # Products need unique barcodes, so each box picking gets its own product
+        self.product_numbers = count(1)
+
+    def assert_query_count_bounded(self, setup):
+        """Assert that the function returned by setup(size) issues no more queries
+        for any of SIZES than it does for the smallest size.
+
+        The path is run once beforehand without counting its queries, so that one-off
+        queries filling caches (such as the warehouse of the user, or the decimal
+        precisions) do not inflate the count of the smallest size.
+        """
+        setup(self.SIZES[0])()
+        counts = {}
+        for size in self.SIZES:
+            func = setup(size)
+            counts[size] = self.count_queries(func)
+        max_count = counts[self.SIZES[0]]
+        for size, count in counts.items():
+            self.assertLessEqual(
+                count,
+                max_count,
+                "%d queries for size %d, expected at most %d" % (count, size, max_count),
+            )
+
+    def create_pallet(self, size):
+        """Create a pallet of size boxes, each containing a quant"""
+        pallets, boxes = self.create_package_hierarchy(
+            self.apple, self.test_location_01, 1, branching=size, depth=2
+        )
+        return pallets
+
+    def create_box_picking(self, size):
+        """Create a pallet of size boxes along with size boxes of its own product, and
+        return a picking reserving the contents of those boxes"""
+        Package = self.env["stock.quant.package"]
+
+        pallet = self.create_pallet(size)
+        product = self.create_product("Cherry%d" % next(self.product_numbers))
+        boxes = Package.create([{"parent_id": pallet.id} for i in range(size)])
+        for box in boxes:
+            self.create_quant(product.id, self.test_location_01.id, 1, package_id=box.id)
+        picking = self.create_picking(
+            self.picking_type_internal, location_dest_id=self.test_location_02.id
+        )
+        self.create_move(product, size, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        self.assertEqual(picking.move_line_ids.package_id, boxes)
+        return picking
+
+    def test_link_creation_query_count(self):
+        """Test that creating links validates them in a bounded number of queries"""
+        Package = self.env["stock.quant.package"]
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        def setup(size):
+            pallets = Package.union(*[self.create_pallet(size) for i in range(size)])
+            trailers = Package.create([{} for i in range(size)])
+            return lambda: PackageHierarchyLink.create(
+                [
+                    {"parent_id": trailer.id, "child_id": pallet.id}
+                    for pallet, trailer in zip(pallets, trailers)
+                ]
+            )
+
+        self.assert_query_count_bounded(setup)
+
+    def test_link_validation_query_count(self):
+        """Test that links are validated in a bounded number of queries"""
+        PackageHierarchyLink = self.env["package.hierarchy.link"]
+
+        def setup(size):
+            vals_list = []
+            for i in range(size):
+                pallet = self.create_pallet(size)
+                other_pallet = self.create_pallet(size)
+                box = pallet.child_ids[0]
+                vals_list.extend(
+                    [
+                        {"parent_id": False, "child_id": box.id},
+                        {"parent_id": other_pallet.id, "child_id": box.id},
+                    ]
+                )
+            links = PackageHierarchyLink.create(vals_list)
+            return links._validate_links
+
+        self.assert_query_count_bounded(setup)
+
+    def test_entire_pack_query_count(self):
+        """Test that the links of entire packages are constructed in a bounded
+        number of queries"""
+
+        def setup(size):
+            picking = self.create_box_picking(size)
+            return picking.move_line_ids.construct_package_hierarchy_links
+
+        self.assert_query_count_bounded(setup)
+
+    def test_action_done_query_count(self):
+        """Test that move lines are completed in a bounded number of queries"""
+
+        def setup(size):
+            picking = self.create_box_picking(size)
+            # Each move line takes the quant of one box
+            picking.move_line_ids.write({"qty_done": 1})
+            return picking._action_done
+
+        self.assert_query_count_bounded(setup)